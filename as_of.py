@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+from dbconfig import shared_connection, epoch_day, format_epoch_day, DB_NAME
+from classification import fetch_student_range, presence_scores, ADJUST_RATES, ADJUST_DAYS_LIMIT, CHUNK_STUDENTS
+from tokenization import read_attendance_features
+from instrumentation import instrumented
+
+# Point-in-time (as-of) metrics
+# The snapshot at a cutoff day is what compute_metrics returns when hasDone only holds the rows handled on or
+# before it. hasTodo, hasWeights and hasPresences carry no event date, so suma_greutati_todo_E and
+# ScorPrezenteExam are the same at every cutoff. Each hasDone row is bucketed once by the first cutoff that
+# sees it; cumulative sums over the cutoff axis then give every snapshot in one pass over the join.
+
+
+# Run id of every row of the sorted key columns, and the first row of every run
+def _runs(*keys) -> tuple:
+    change = np.zeros(len(keys[0]), dtype=bool)
+    change[:1] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+
+    return np.cumsum(change) - 1, np.flatnonzero(change)
+
+
+# As-of components of one classification frame (ordered by student, course, exam type, todo) for sorted cutoffs:
+# (student, course) keys and ScorPrezenteExam per pair, PunctajComponentaExamene / adjustment as (pairs x cutoffs)
+def as_of_metrics(data: pd.DataFrame, cutoffs: np.ndarray) -> dict:
+    n_cutoffs = len(cutoffs)
+    student = data['student_id'].to_numpy()
+    course = data['course_id'].to_numpy()
+
+    pair, pair_starts = _runs(student, course)
+    group, _ = _runs(student, course, data['exam_type_id'].to_numpy())
+    n_pairs = len(pair_starts)
+
+    # First cutoff that sees each row, n_cutoffs when none does (never handled, or handled after the last one)
+    handled = data['handled'].to_numpy(dtype=np.float64, na_value=np.nan)
+    first_cutoff = np.where(np.isnan(handled), n_cutoffs, np.searchsorted(cutoffs, handled, side='left'))
+
+    # PunctajComponentaExamene = (1 + adjustment / 100) * sum over exam types of
+    # scor_total_todo_E / suma_greutati_todo_E * exam_weight, where only the handled rows add to scor_total_todo_E
+    todo_weight = data['todo_weight'].to_numpy(dtype=np.float64, na_value=np.nan)
+    weight_sums = np.bincount(group, np.nan_to_num(todo_weight))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        todo_score = data['points'].to_numpy(dtype=np.float64, na_value=np.nan) / \
+                     data['max_points'].to_numpy(dtype=np.float64, na_value=np.nan) * todo_weight
+        component = np.nan_to_num(todo_score / weight_sums[group] * data['exam_weight'].to_numpy(dtype=np.float64))
+
+    todo_points = np.bincount(pair * (n_cutoffs + 1) + first_cutoff, component, minlength=n_pairs * (n_cutoffs + 1))\
+                    .reshape(n_pairs, n_cutoffs + 1).cumsum(axis=1)[:, :n_cutoffs]
+
+    # Delay/bonus: adjust_todos' per-student rate sequence, restricted at each cutoff to the todos handled by then
+    diff_days = data['diff_days'].to_numpy(dtype=np.float64, na_value=0)
+    deadline = data['deadline'].to_numpy(dtype=np.float64, na_value=np.nan)
+    eligible = np.flatnonzero((diff_days != 0) & ~np.isnan(handled))
+    events = eligible[np.lexsort((deadline[eligible], course[eligible], student[eligible]))]
+
+    # (events x cutoffs): whether the cutoff sees the event, and its position in the student's sequence there
+    seen = first_cutoff[events][:, None] <= np.arange(n_cutoffs)
+    seen_count = np.cumsum(seen, axis=0, dtype=np.int32)
+    student_run, student_starts = _runs(student[events])
+    seen_before = np.concatenate([np.zeros((1, n_cutoffs), dtype=np.int32), seen_count])[student_starts]
+    rate_index = seen_count - seen - seen_before[student_run]
+
+    rates = np.asarray(ADJUST_RATES)
+    in_sequence = seen & (rate_index < len(rates))
+    adjust_rate = np.where(in_sequence, rates[np.clip(rate_index, 0, len(rates) - 1)], 0.0)
+
+    event_diff = diff_days[events][:, None]
+    event_adjust = -np.sign(event_diff) * adjust_rate * np.minimum(np.abs(event_diff), ADJUST_DAYS_LIMIT) * 100
+
+    adjustment = np.zeros((n_pairs, n_cutoffs))
+    if len(events):
+        _, event_pair_starts = _runs(pair[events])
+        adjustment[pair[events][event_pair_starts]] = np.add.reduceat(event_adjust, event_pair_starts, axis=0)
+
+    return {
+        'student_id': student[pair_starts],
+        'course_id': course[pair_starts],
+        'PunctajComponentaExamene': todo_points * (1 + adjustment / 100.0),
+        'ScorPrezenteExam': presence_scores(data)['ScorPrezenteExam'].to_numpy(dtype=np.float64),
+        'Ajustare_Delay/Bonus': adjustment,
+    }
+
+
+# (cutoff, student_id, course_id) feature table for every cutoff (epoch days), ordered by cutoff, student, course
+# Streams the join by student id ranges like compute_metrics_chunked: the delay/bonus sequence is per student
+@instrumented('snapshots', rows=len)
+def as_of_features(conn, cutoffs, chunk_students=CHUNK_STUDENTS) -> pd.DataFrame:
+    cutoffs = np.unique(np.asarray(cutoffs, dtype=np.int64))
+
+    first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM Student;").fetchone()
+    chunks = []
+
+    for start in range(first_id, last_id + 1, chunk_students) if first_id is not None else []:
+        data = fetch_student_range(conn, start, min(start + chunk_students - 1, last_id))
+        if not data.empty:
+            chunks.append(as_of_metrics(data, cutoffs))
+
+    if not chunks:
+        chunks.append(as_of_metrics(fetch_student_range(conn, 0, -1), cutoffs))
+
+    merged = {column: np.concatenate([chunk[column] for chunk in chunks]) for column in chunks[0]}
+    n_pairs = len(merged['student_id'])
+
+    # Matrices are (pairs x cutoffs): their transpose, flattened, is cutoff-major
+    return pd.DataFrame({
+        'cutoff': np.repeat(cutoffs, n_pairs).astype(np.int32),
+        'student_id': np.tile(merged['student_id'], len(cutoffs)),
+        'course_id': np.tile(merged['course_id'], len(cutoffs)),
+        'PunctajComponentaExamene': merged['PunctajComponentaExamene'].T.ravel(),
+        'ScorPrezenteExam': np.tile(merged['ScorPrezenteExam'], len(cutoffs)),
+        'Ajustare_Delay/Bonus': merged['Ajustare_Delay/Bonus'].T.ravel(),
+    })
+
+
+# As-of snapshots labelled with the final Class materialized in AttendanceStats, ready for run_fd_tokenization
+# cutoff_dates: dd.mm.yyyy strings
+def run_as_of_snapshots(cutoff_dates, chunk_students=CHUNK_STUDENTS, db_file=DB_NAME) -> pd.DataFrame:
+    print("\n\n>>> Building point-in-time snapshots <<<\n")
+
+    print(f"Trying to connect to {db_file}...")
+    conn = shared_connection(db_file)
+    if not conn:
+        print("Database operation aborted.")
+        return None
+
+    final = read_attendance_features(conn)
+    if not len(final['Class']):
+        print("AttendanceStats is empty, run `python3 main.py classify` first")
+        return None
+
+    snapshots = as_of_features(conn, [epoch_day(value) for value in cutoff_dates], chunk_students)
+    snapshots = snapshots.merge(pd.DataFrame({key: final[key] for key in ['student_id', 'course_id', 'Class']}),
+                                on=['student_id', 'course_id'], how='inner')
+
+    for cutoff, rows in snapshots.groupby('cutoff', sort=True):
+        print(f"\t{format_epoch_day(cutoff)}: {len(rows):,} (student, course) rows, "
+              f"mean PunctajComponentaExamene {rows['PunctajComponentaExamene'].mean():.2f}, "
+              f"mean adjustment {rows['Ajustare_Delay/Bonus'].mean():+.3f}")
+
+    return snapshots
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import contextlib
+from dbconfig import close_connections
+from dataconfig import run_db_bulk_seed, BULK_BATCH_SIZE
+from classification import run_db_classification, current_rss, CHUNK_STUDENTS, CLASSIFICATION_BACKENDS
+from tokenization import run_fd_tokenization
+from naive_bayes import run_naive_bayes
+
+BENCH_SCALES = [1_000, 10_000, 100_000, 1_000_000]
+BENCH_DB = 'data/bench.db'
+BENCH_RESULTS = 'data/bench_results.json'
+BENCH_THRESHOLD = 0.25
+BENCH_SEED = 42
+
+# A stage shorter than this is reported but never fails the comparison (timer noise dominates)
+MIN_COMPARED_SECONDS = 0.05
+
+
+# Samples the RSS in a background thread: the peak above the RSS at start is the stage's memory
+class PeakMemory:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.start = self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+    @property
+    def peak_mb(self):
+        return (self.peak - self.start) / (1024 * 1024)
+
+
+# Runs one stage with its output silenced; `rows` maps the stage's result to the rows it produced,
+# `nbytes` (optional) to the memory its result holds
+def measure(stage, students, fn, rows, verbose=False, nbytes=None):
+    with open(os.devnull, 'w') as devnull, PeakMemory() as memory, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+
+    n_rows = rows(result)
+    record = {
+        'stage': stage,
+        'students': students,
+        'wall_time_s': elapsed,
+        'peak_memory_mb': memory.peak_mb,
+        'rows': n_rows,
+        'rows_per_s': n_rows / max(elapsed, 1e-9),
+        'output_mb': nbytes(result) / (1024 * 1024) if nbytes is not None else None,
+    }
+
+    output = f"  output {record['output_mb']:.1f} MB" if nbytes is not None else ""
+    print(f"\t{stage:<16} {students:>10,} students  {elapsed:9.2f}s  {memory.peak_mb:9.1f} MB  "
+          f"{n_rows:>12,} rows  {record['rows_per_s']:>12,.0f} rows/s{output}")
+    return record, result
+
+
+def bench_scale(students, db_file=BENCH_DB, seed=BENCH_SEED, workers=1, backend='pandas', chunk_students=CHUNK_STUDENTS,
+                classify_workers=None, verbose=False):
+    records = []
+
+    # Bulk seeder: the row-by-row run_db_seed does not get past a few thousand students in reasonable time
+    record, _ = measure('seed', students,
+                        lambda: run_db_bulk_seed(students, batch_size=BULK_BATCH_SIZE, seed=seed, workers=workers, db_file=db_file),
+                        lambda report: sum(rows for rows, _ in report.tables.values()), verbose)
+    records.append(record)
+
+    record, final_data = measure('classification', students,
+                                 lambda: run_db_classification(chunk_students=chunk_students, backend=backend, db_file=db_file,
+                                                               workers=classify_workers),
+                                 len, verbose)
+    records.append(record)
+
+    record, dataset = measure('tokenization', students, lambda: run_fd_tokenization(final_data), len, verbose,
+                              lambda dataset: dataset.nbytes)
+    records.append(record)
+
+    record, _ = measure('training', students, lambda: run_naive_bayes(dataset), lambda _: len(dataset), verbose)
+    records.append(record)
+
+    close_connections(db_file)
+    for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(db_file + suffix):
+            os.remove(db_file + suffix)
+
+    return records
+
+
+# Returns the (stage, students) pairs slower than baseline * (1 + threshold)
+def compare_results(results, baseline, threshold=BENCH_THRESHOLD):
+    reference = {(record['stage'], record['students']): record for record in baseline['results']}
+    regressions = []
+
+    print(f"\nComparison with the baseline (threshold +{threshold:.0%})")
+    for record in results['results']:
+        base = reference.get((record['stage'], record['students']))
+        if base is None:
+            continue
+
+        ratio = record['wall_time_s'] / max(base['wall_time_s'], 1e-9)
+        failed = ratio > 1 + threshold and record['wall_time_s'] >= MIN_COMPARED_SECONDS
+        if failed:
+            regressions.append(record)
+
+        print(f"\t{'FAIL' if failed else 'ok  '} {record['stage']:<16} {record['students']:>10,} students  "
+              f"{base['wall_time_s']:9.2f}s -> {record['wall_time_s']:9.2f}s  ({ratio - 1:+.1%})")
+
+    return regressions
+
+
+# With repeat > 1 every stage keeps its fastest run, which is the least noisy estimate
+def run_benchmarks(scales=BENCH_SCALES, repeat=1, **kwargs):
+    print(">>> Benchmarking pipeline stages <<<")
+
+    results = []
+    for students in scales:
+        runs = [bench_scale(students, **kwargs) for _ in range(repeat)]
+        results.extend(min(records, key=lambda record: record['wall_time_s']) for records in zip(*runs))
+
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+# Command line entry point, also behind `main.py bench`; returns 1 when a stage regressed
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times every pipeline stage on synthetic databases of several sizes")
+    parser.add_argument('--scales', type=int, nargs='+', default=BENCH_SCALES, help="student counts")
+    parser.add_argument('--output', default=BENCH_RESULTS)
+    parser.add_argument('--baseline', default=None, help="results file to compare with")
+    parser.add_argument('--threshold', type=float, default=BENCH_THRESHOLD, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per scale, the fastest one is kept")
+    parser.add_argument('--db', default=BENCH_DB)
+    parser.add_argument('--seed', type=int, default=BENCH_SEED)
+    parser.add_argument('--workers', type=int, default=1, help="bulk seeding processes")
+    parser.add_argument('--backend', choices=CLASSIFICATION_BACKENDS, default='pandas')
+    parser.add_argument('--chunk-students', type=int, default=CHUNK_STUDENTS)
+    parser.add_argument('--classify-workers', type=int, default=None, help="classification processes")
+    parser.add_argument('--verbose', action='store_true', help="keeps the stages' own output")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scales, args.repeat, db_file=args.db, seed=args.seed, workers=args.workers,
+                             backend=args.backend, chunk_students=args.chunk_students, classify_workers=args.classify_workers,
+                             verbose=args.verbose)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare_results(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stage(s) slower than the baseline")
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
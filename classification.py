@@ -1,11 +1,29 @@
+import os
+import sys
 import random
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from dbconfig import create_connection, DB_NAME
+from multiprocessing import Pool
+from dbconfig import shared_connection, create_connection, epoch_day, DB_NAME
+from instrumentation import instrumented, span
 
 DATE_FORMAT = "%d.%m.%Y"
 
+# Calculation dates are drawn from CALCULATION_INTERVAL; presences / todos weigh 80 / 20 before
+# WEIGHTS_SWITCH_DATE and 60 / 40 from it on
+CALCULATION_INTERVAL = ("01.10.2025", "01.02.2026")
+WEIGHTS_SWITCH_DATE = "01.01.2026"
+EARLY_WEIGHTS = (80, 20)
+LATE_WEIGHTS = (60, 40)
+
+PASSING_GRADE = 5.0
+
+# (w_presence, w_todos) of every calculation date (epoch days), shape (dates x 2)
+def date_weights(calc_days) -> np.ndarray:
+    early = np.asarray(calc_days).reshape(-1, 1) < epoch_day(WEIGHTS_SWITCH_DATE)
+    return np.where(early, EARLY_WEIGHTS, LATE_WEIGHTS)
+
 def get_init_data():
     def get_random_date(start_date_str, end_date_str):
         start_date = datetime.strptime(start_date_str, DATE_FORMAT)
@@ -19,78 +37,145 @@ def get_init_data():
 
         return random_date
 
+    # Random calculation date
+    calc_date = get_random_date(*CALCULATION_INTERVAL)
 
-    def get_datetime_dependency(calc_date, data_thresholds):
-        if calc_date < data_thresholds[1]:
-            return 80, 20
-        elif calc_date < data_thresholds[0]:
-            return 60, 40
+    # Default datetime dependent presences / todos weights 
+    w_presence, w_todos = date_weights([epoch_day(calc_date.date())])[0].tolist()
+    return w_presence, w_todos
+
+CLASSIFICATION_SELECT = """
+    SELECT
+        S.id AS student_id,
+        HW.course_id AS course_id,
+        HW.exam_type_id AS exam_type_id,
+        HW.weight AS exam_weight,
+        HW.required_presences,
+        HT.todo_id AS todo_id,
+        HT.max_points,
+        HT.weight AS todo_weight,
+        HT.deadline,
+        HD.points,
+        HD.handled,
+        HD.handled - HT.deadline AS diff_days,
+        HP.presences
+    FROM Student S
+    JOIN Course C
+    JOIN hasWeights HW ON C.id = HW.course_id
+    LEFT JOIN hasTodo HT ON C.id = HT.course_id AND HW.exam_type_id = HT.exam_type_id
+    LEFT JOIN hasDone HD ON S.id = HD.student_id AND HT.todo_id = HD.todo_id
+    LEFT JOIN hasPresences HP ON S.id = HP.student_id AND C.id = HP.course_id AND HW.exam_type_id = HP.exam_type_id
+"""
+
+# Student x Course join used by every classification path, optionally filtered (e.g. "WHERE S.id = ?")
+def classification_query(where: str = "") -> str:
+    return f"{CLASSIFICATION_SELECT} {where} ORDER BY student_id, course_id, exam_type_id, todo_id;"
+
+# Column types of the classification frame: ids as int32, weights / presences as small ints, deadline / handled
+# as epoch days. The nullable columns (LEFT JOIN) use <NA>. Points and todo weights stay float64: a REAL such as
+# 3.3 has no exact float32 value, and upcasting after the read keeps the rounding, so a grade exactly on
+# PASSING_GRADE (as SQLite computes it) could fall just below it
+CLASSIFICATION_DTYPES = {
+    'student_id': 'int32',
+    'course_id': 'int32',
+    'exam_type_id': 'int8',
+    'exam_weight': 'int16',
+    'required_presences': 'int16',
+    'todo_id': 'Int32',
+    'max_points': 'float64',
+    'todo_weight': 'float64',
+    'deadline': 'Int32',
+    'points': 'float64',
+    'handled': 'Int32',
+    'diff_days': 'Int16',
+    'presences': 'Int16',
+}
+
+# Rows converted from Python objects at a time by read_classification_frame
+CLASSIFICATION_FETCH_ROWS = 50_000
+
+CLASSIFICATION_BACKENDS = ('pandas', 'sql')
+
+# Students fetched per chunk in streaming mode, and the compute_metrics footprint relative to the fetched frame
+CHUNK_STUDENTS = 1000
+METRICS_MEMORY_FACTOR = 4
+
+ADJUST_RATES = [0.0005, 0.001, 0.002, 0.004, 0.008]
+ADJUST_DAYS_LIMIT = 30
+
+# Geometric delay/bonus adjustment per (student, course)
+# Each student consumes ADJUST_RATES in order (courses ascending, todos by deadline) for every
+# todo handled off-deadline; once the rates are exhausted the remaining todos adjust by 0
+@instrumented('metrics.adjust_todos', rows=len)
+def adjust_todos(data: pd.DataFrame) -> pd.DataFrame:
+    events = data[['student_id', 'course_id', 'deadline', 'handled', 'diff_days']]\
+                .sort_values(by=['student_id', 'course_id', 'deadline'], kind='stable')
+
+    diff_days = events['diff_days'].to_numpy()
+    eligible = (diff_days != 0) & events['handled'].notna().to_numpy()
+
+    # Position of each eligible todo in its student's rate sequence
+    rate_index = pd.Series(eligible, index=events.index).groupby(events['student_id']).cumsum().to_numpy() - 1
+
+    rates = np.asarray(ADJUST_RATES)
+    in_sequence = eligible & (rate_index < len(rates))
+    adjust_rate = np.where(in_sequence, rates[np.clip(rate_index, 0, len(rates) - 1)], 0.0)
+
+    days_limit = np.minimum(np.abs(diff_days), ADJUST_DAYS_LIMIT)
+    final_adjust = -np.sign(diff_days) * adjust_rate * days_limit * 100
+
+    adjustments = pd.Series(final_adjust, index=events.index)\
+                    .groupby([events['student_id'], events['course_id']]).sum()
+
+    return adjustments.rename('Ajustare_Delay/Bonus').reset_index()
+
+# NotaAproximativa and Class from the per-(student, course) components
+def grade_metrics(final_data: pd.DataFrame, weights=None) -> pd.DataFrame:
+    w_presence, w_todos = weights if weights is not None else get_init_data()
 
-        return 60, 40 # Default case
+# Applies datetime dependent weights for presences and tasks
+    final_data['NotaAproximativa'] = (
+        (final_data['PunctajComponentaExamene'] * w_todos) + 
+        (final_data['ScorPrezenteExam'] * w_presence)
+    ) / 1000.0 
 
-    # Random calculation date
-    calc_date = get_random_date("01.10.2025", "01.02.2026")
+    # Final class tagging
+    final_data['Class'] = np.where(final_data['NotaAproximativa'] >= PASSING_GRADE, 'Promovat', 'Nepromovat')
+
+    return final_data
+
+# ScorPrezenteExam per (student, course): the exam weights whose required presences are met, in percent
+def presence_scores(data: pd.DataFrame) -> pd.DataFrame:
+# IndeplinitPrezente(E)
+    # Keeps only relevant data
+    presences_data = data[['student_id', 'course_id', 'exam_type_id', 'presences', 'required_presences', 'exam_weight']]\
+                    .drop_duplicates() 
     
-    # Datatime dependencies thresholds
-    data_thresholds = list(map(lambda x: datetime.strptime(x, "%d.%m.%Y"), ["01.12.2025", "01.01.2026"]))
+    # A missing presences row (<NA>) does not meet the requirement
+    presences_data['IndeplinitPrezente_E'] = (presences_data['presences'] >= presences_data['required_presences'])\
+                                                .fillna(False).astype(bool)
 
-    # Default datetime dependent presences / todos weights 
-    return get_datetime_dependency(calc_date, data_thresholds)
-
-student_adjustments = {}
-def adjust_todo(group: pd.DataFrame) -> pd.DataFrame:
-    global student_adjustments
-
-    def adjust_generator():
-        rates = [0.0005, 0.001, 0.002, 0.004, 0.008] 
-        rate_index = 0
-        
-        while True:
-            if rate_index < len(rates):
-                yield rates[rate_index]
-                rate_index += 1
-            else:
-                yield 0
-
-    student_id = group.name[0]
-
-    if student_id not in student_adjustments:
-        student_adjustments[student_id] = {'gen': adjust_generator(), 'count': 0}
-
-    group = group.sort_values(by='deadline', ascending=True)
-
-    final_adjustment_percent = 0
-
-    for index, row in group.iterrows():
-        diff_days = row['diff_days']
-        
-        if diff_days != 0 and pd.notna(row['handled']):
-            
-            try:
-                adjust_rate = next(student_adjustments[student_id]['gen']) 
-            except StopIteration:
-                adjust_rate = 0 
-                
-            days_limit = min(abs(diff_days), 30)
-            
-            final_adjust = adjust_rate * days_limit * 100
-            
-            if diff_days > 0:
-                final_adjustment_percent -= final_adjust
-            elif diff_days < 0:
-                final_adjustment_percent += final_adjust
-                
-    return pd.Series({
-        'Ajustare_Delay/Bonus': final_adjustment_percent,
-        'PunctajNormalizatTodo_E_Unic': group['PunctajNormalizatTodo_E'].iloc[0]
-    })
-
-def compute_metrics(data: pd.DataFrame) -> pd.DataFrame:
-    w_presence, w_todos = get_init_data()
-
-    data['handled'] = pd.to_datetime(data['handled'], format="%d.%m.%Y", errors='coerce')
-    data['deadline'] = pd.to_datetime(data['deadline'], format="%d.%m.%Y", errors='coerce')
 
+    # Ponderates presences with exam's weight
+    presences_data['scor_prezenta_ponderat'] = presences_data['IndeplinitPrezente_E'] * presences_data['exam_weight']
+
+
+    # Aggregates and computes a final presence score
+    presences_scores = presences_data.groupby(['student_id', 'course_id']).agg(
+        scor_prezenta_total=('scor_prezenta_ponderat', 'sum'),
+        total_greutati_exam=('exam_weight', 'sum')
+    ).reset_index()
+
+    presences_scores['ScorPrezenteExam'] = (
+        presences_scores['scor_prezenta_total'] / presences_scores['total_greutati_exam']
+    ) * 100
+
+    return presences_scores[['student_id', 'course_id', 'ScorPrezenteExam']]
+
+# weights: (presences, todos) weights, drawn from a random calculation date when omitted
+@instrumented('metrics.compute', rows=len)
+def compute_metrics(data: pd.DataFrame, weights=None) -> pd.DataFrame:
+    weights = weights if weights is not None else get_init_data()
 # ScorTotalTodo(E)
     data['scor_total_todo'] = (data['points'] / data['max_points']) * data['todo_weight']
 
@@ -105,26 +190,21 @@ def compute_metrics(data: pd.DataFrame) -> pd.DataFrame:
         todo_scores['scor_total_todo_E'] / todo_scores['suma_greutati_todo_E']
     ) * 100
 
-    data = data.merge(todo_scores[['student_id', 'course_id', 'exam_type_id', 'PunctajNormalizatTodo_E', 'suma_greutati_todo_E']],
-                      on=['student_id', 'course_id', 'exam_type_id'], 
-                      how='left')
-    
 
-# Delay/Bonus adjustments
-    data['diff_days'] = data.apply(lambda row: (row['handled'] - row['deadline']).days if pd.notna(row['handled']) else 0, axis=1)
+# Delay/Bonus adjustments (diff_days = handled - deadline comes from the query, 0 when not handled)
+    data['diff_days'] = data['diff_days'].fillna(0).astype('int16')
 
 
 # Applies bonuses/delays
-    adjustments = data.groupby(['student_id', 'course_id']).apply(adjust_todo, include_groups=False).reset_index()
-    final_scores = todo_scores.merge(adjustments[['student_id', 'course_id', 'Ajustare_Delay/Bonus']],
-                                     on=['student_id', 'course_id'], 
-                                     how='left')
+    adjustments = adjust_todos(data)
+    with span('metrics.merges'):
+        final_scores = todo_scores.merge(adjustments,
+                                         on=['student_id', 'course_id'], 
+                                         how='left')
 
 
 # PunctajAjustatTodo_E = PunctajNormalizatTodo_E * (1 + Ajustare_Delay/Bonus / 100)
-    final_scores['PunctajAjustatTodo_E'] = final_scores.apply(
-        lambda row: row['PunctajNormalizatTodo_E'] * (1 + row['Ajustare_Delay/Bonus'] / 100.0), axis=1
-    )
+    final_scores['PunctajAjustatTodo_E'] = final_scores['PunctajNormalizatTodo_E'] * (1 + final_scores['Ajustare_Delay/Bonus'] / 100.0)
 
 
 # PunctajComponentaExamene (PCE)
@@ -138,99 +218,384 @@ def compute_metrics(data: pd.DataFrame) -> pd.DataFrame:
 
 # Aggregation of PCE to [Student_Id, Course_Id]
     pce = final_scores.groupby(['student_id', 'course_id'])['PunctajComponentaExamene'].sum().reset_index()
-    pce.rename(columns={'PunctajComponentaExamene': 'PunctajComponentaExamene'}, inplace=True)
 
 
-# IndeplinitPrezente(E)
-    # Keeps only relevant data
-    presences_data = data[['student_id', 'course_id', 'exam_type_id', 'presences', 'required_presences', 'exam_weight']]\
-                    .drop_duplicates() 
-    
-    presences_data['IndeplinitPrezente_E'] = presences_data.apply(lambda row: row['presences'] >= row['required_presences'], axis=1)
+# ScorPrezenteExam per (student, course)
+    presences_scores = presence_scores(data)
 
+    with span('metrics.merges'):
+        final_data = pce.merge(presences_scores, 
+                                on=['student_id', 'course_id'], 
+                                how='inner')
+
+        final_data = final_data.merge(adjustments, 
+                                    on=['student_id', 'course_id'], 
+                                    how='left')
+
+
+    return grade_metrics(final_data, weights)
+
+
+
+# Same components as compute_metrics, aggregated inside SQLite: one row per (student, course)
+# The delay/bonus rate sequence is a per-student ROW_NUMBER over the todos handled off-deadline,
+# in the (course, deadline, exam type, todo) order used by adjust_todos
+def metrics_query(where: str = "") -> str:
+    rate_cases = " ".join(f"WHEN {rank} THEN {rate}" for rank, rate in enumerate(ADJUST_RATES, start=1))
+
+    return f"""
+    WITH students AS (
+        SELECT S.id FROM Student S {where}
+    ),
+    todo_rows AS (
+        SELECT
+            SS.id AS student_id,
+            HW.course_id AS course_id,
+            HW.exam_type_id AS exam_type_id,
+            HW.weight AS exam_weight,
+            HT.todo_id AS todo_id,
+            HT.max_points,
+            HT.weight AS todo_weight,
+            HD.points,
+            HT.deadline,
+            HD.handled - HT.deadline AS diff_days
+        FROM students SS
+        JOIN hasWeights HW
+        LEFT JOIN hasTodo HT ON HW.course_id = HT.course_id AND HW.exam_type_id = HT.exam_type_id
+        LEFT JOIN hasDone HD ON SS.id = HD.student_id AND HT.todo_id = HD.todo_id
+    ),
+    exam_scores AS (
+        SELECT
+            student_id, course_id, exam_weight,
+            TOTAL(points * 1.0 / max_points * todo_weight) / TOTAL(todo_weight) * 100 AS PunctajNormalizatTodo_E
+        FROM todo_rows
+        GROUP BY student_id, course_id, exam_type_id
+    ),
+    adjust_events AS (
+        SELECT
+            student_id, course_id,
+            diff_days,
+            ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY course_id, deadline, exam_type_id, todo_id) AS rate_rank
+        FROM todo_rows
+        WHERE diff_days != 0
+    ),
+    adjustments AS (
+        SELECT
+            student_id, course_id,
+            TOTAL(CASE WHEN diff_days > 0 THEN -1 ELSE 1 END
+                  * CASE rate_rank {rate_cases} ELSE 0 END
+                  * MIN(ABS(diff_days), {ADJUST_DAYS_LIMIT}) * 100) AS adjustment
+        FROM adjust_events
+        GROUP BY student_id, course_id
+    ),
+    course_scores AS (
+        SELECT
+            E.student_id, E.course_id,
+            COALESCE(A.adjustment, 0.0) AS adjustment,
+            TOTAL(E.PunctajNormalizatTodo_E * (1 + COALESCE(A.adjustment, 0.0) / 100.0) * (E.exam_weight / 100.0)) AS pce
+        FROM exam_scores E
+        LEFT JOIN adjustments A ON E.student_id = A.student_id AND E.course_id = A.course_id
+        GROUP BY E.student_id, E.course_id
+    ),
+    presence_scores AS (
+        SELECT
+            SS.id AS student_id,
+            HW.course_id AS course_id,
+            TOTAL(CASE WHEN HP.presences >= HW.required_presences THEN HW.weight ELSE 0 END) / TOTAL(HW.weight) * 100 AS spe
+        FROM students SS
+        JOIN hasWeights HW
+        LEFT JOIN hasPresences HP ON SS.id = HP.student_id AND HW.course_id = HP.course_id AND HW.exam_type_id = HP.exam_type_id
+        GROUP BY SS.id, HW.course_id
+    )
+    SELECT
+        CS.student_id,
+        CS.course_id,
+        CS.pce AS PunctajComponentaExamene,
+        P.spe AS ScorPrezenteExam,
+        CS.adjustment AS "Ajustare_Delay/Bonus"
+    FROM course_scores CS
+    JOIN presence_scores P ON CS.student_id = P.student_id AND CS.course_id = P.course_id
+    ORDER BY CS.student_id, CS.course_id;
+    """
 
-    # Ponderates presences with exam's weight
-    presences_data['scor_prezenta_ponderat'] = presences_data['IndeplinitPrezente_E'] * presences_data['exam_weight']
 
+def compute_metrics_sql(conn, where: str = "", params=(), weights=None) -> pd.DataFrame:
+    with span('metrics.sql') as step:
+        final_data = pd.read_sql_query(metrics_query(where), conn, params=params)
+        step.rows = len(final_data)
+    return grade_metrics(final_data, weights)
 
-    # Aggregates and computes a final presence score
-    presences_scores = presences_data.groupby(['student_id', 'course_id']).agg(
-        scor_prezenta_total=('scor_prezenta_ponderat', 'sum'),
-        total_greutati_exam=('exam_weight', 'sum')
-    ).reset_index()
 
-    presences_scores['ScorPrezenteExam'] = (
-        presences_scores['scor_prezenta_total'] / presences_scores['total_greutati_exam']
-    ) * 100
+# Runs both backends on the same students and weights, returns the largest absolute difference per column
+def compare_backends(conn, first_id, last_id) -> dict:
+    weights = get_init_data()
+    where = "WHERE S.id BETWEEN ? AND ?"
 
-    final_data = pce.merge(presences_scores[['student_id', 'course_id', 'ScorPrezenteExam']], 
-                            on=['student_id', 'course_id'], 
-                            how='inner')
-    
-    adjustment_unique = adjustments[['student_id', 'course_id', 'Ajustare_Delay/Bonus']].drop_duplicates()
+    pandas_data = compute_metrics(fetch_student_range(conn, first_id, last_id), weights)
+    sql_data = compute_metrics_sql(conn, where, (first_id, last_id), weights)
 
-    final_data = final_data.merge(adjustment_unique, 
-                                on=['student_id', 'course_id'], 
-                                how='left')
+    differences = {'rows': (len(pandas_data), len(sql_data))}
+    for column in pandas_data.columns:
+        if pandas_data[column].dtype.kind in 'fi':
+            differences[column] = float(np.abs(pandas_data[column].to_numpy() - sql_data[column].to_numpy()).max())
+        else:
+            differences[column] = int((pandas_data[column].to_numpy() != sql_data[column].to_numpy()).sum())
 
+    return differences
 
-# Applies datetime dependent weights for presences and tasks
-    final_data['NotaAproximativa'] = (
-        (final_data['PunctajComponentaExamene'] * w_todos) + 
-        (final_data['ScorPrezenteExam'] * w_presence)
-    ) / 1000.0 
 
-    # Final class tagging
-    final_data['Class'] = np.where(final_data['NotaAproximativa'] >= 5.0, 'Promovat', 'Nepromovat')
-    
-    return final_data
+# Current resident set size in bytes (peak RSS where /proc is not available)
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return 0
+
+
+# Classification join with CLASSIFICATION_DTYPES, converted block by block so that only
+# CLASSIFICATION_FETCH_ROWS rows are held as Python objects at once
+def read_classification_frame(conn, where: str = "", params=()) -> pd.DataFrame:
+    with span('classification.fetch') as step:
+        blocks = pd.read_sql_query(classification_query(where), conn, params=params,
+                                   dtype=CLASSIFICATION_DTYPES, chunksize=CLASSIFICATION_FETCH_ROWS)
+        data = pd.concat(list(blocks), ignore_index=True)
+        step.rows = len(data)
+    return data
+
+
+def fetch_student_range(conn, first_id, last_id) -> pd.DataFrame:
+    return read_classification_frame(conn, "WHERE S.id BETWEEN ? AND ?", (first_id, last_id))
+
+
+# Streams the join by student id ranges; every metric (including the delay/bonus sequence) is per student,
+# so only the small per-(student, course) results are kept. With memory_limit_mb, the chunk size adapts
+# so that RSS + the next chunk's estimated footprint stays under the ceiling
+def compute_metrics_chunked(conn, chunk_students=CHUNK_STUDENTS, memory_limit_mb=None, weights=None) -> pd.DataFrame:
+    weights = weights if weights is not None else get_init_data()
+    memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb else None
+
+    first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM Student;").fetchone()
+    results = []
+
+    next_id = first_id
+    while first_id is not None and next_id <= last_id:
+        chunk_last_id = min(next_id + chunk_students - 1, last_id)
+
+        data = fetch_student_range(conn, next_id, chunk_last_id)
+        chunk_bytes = data.memory_usage(deep=True).sum() * METRICS_MEMORY_FACTOR
+        if not data.empty:
+            results.append(compute_metrics(data, weights))
+        del data
+
+        print(f"\tClassified students {next_id:,} - {chunk_last_id:,}")
+
+        if memory_limit:
+            available = memory_limit - current_rss()
+            bytes_per_student = max(chunk_bytes / (chunk_last_id - next_id + 1), 1)
+            chunk_students = int(min(max(available / bytes_per_student, 1), 4 * chunk_students))
+            if available <= 0:
+                print(f"\tWarning: RSS is above the {memory_limit_mb} MB ceiling, continuing one student at a time")
+
+        next_id = chunk_last_id + 1
+
+    if not results:
+        return compute_metrics(fetch_student_range(conn, 0, -1), weights)
+
+    return pd.concat(results, ignore_index=True)
+
+
+# Worker state for the parallel mode, set once per process: a read-only connection and the calculation weights
+_shard_worker = None
 
+def init_shard_worker(db_file, weights, backend):
+    global _shard_worker
+    _shard_worker = {'conn': create_connection(db_file, read_only=True), 'weights': weights, 'backend': backend}
 
-def run_db_classification():
+
+# Metrics of one (first_id, last_id) student range, None when the range holds no student
+def classify_shard(student_range):
+    ctx = _shard_worker
+    if ctx['backend'] == 'sql':
+        return compute_metrics_sql(ctx['conn'], "WHERE S.id BETWEEN ? AND ?", student_range, ctx['weights'])
+
+    data = fetch_student_range(ctx['conn'], *student_range)
+    return compute_metrics(data, ctx['weights']) if not data.empty else None
+
+
+# Student ranges of chunk_students ids are classified by a process pool, each worker reading through its own
+# read-only connection. Every metric is per student, so the ranges are independent; results are collected
+# in range order, which gives the same frame as the serial path
+def compute_metrics_parallel(conn, db_file, workers, chunk_students=CHUNK_STUDENTS, weights=None, backend='pandas') -> pd.DataFrame:
+    weights = weights if weights is not None else get_init_data()
+
+    first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM Student;").fetchone()
+    ranges = [(start, min(start + chunk_students - 1, last_id)) for start in range(first_id, last_id + 1, chunk_students)] \
+             if first_id is not None else []
+
+    results = []
+    with Pool(workers, initializer=init_shard_worker, initargs=(db_file, weights, backend)) as pool:
+        for (range_first, range_last), result in zip(ranges, pool.imap(classify_shard, ranges)):
+            if result is not None:
+                results.append(result)
+            print(f"\tClassified students {range_first:,} - {range_last:,}")
+
+    if not results:
+        return compute_metrics(fetch_student_range(conn, 0, -1), weights)
+
+    return pd.concat(results, ignore_index=True)
+
+
+# backend='sql' aggregates inside SQLite; workers > 1 classifies student ranges in a process pool (both backends);
+# otherwise chunk_students / memory_limit_mb switch the pandas backend
+# to the streaming, bounded-memory mode; materialize=True also rebuilds AttendanceStats from the results
+@instrumented('classification', rows=len)
+def run_db_classification(chunk_students=None, memory_limit_mb=None, backend='pandas', materialize=False, db_file=DB_NAME, workers=None):
     print("\n\n>>> Started data classification <<<\n")
 
-    print(f"Trying to connect to {DB_NAME}...")
-    conn = create_connection(DB_NAME)
-    if conn:
-        query = """
-            SELECT
-                S.id AS student_id,
-                HW.course_id AS course_id,
-                HW.exam_type_id AS exam_type_id,
-                HW.weight AS exam_weight,
-                HW.required_presences,
-                HT.todo_id AS todo_id,
-                HT.max_points,
-                HT.weight AS todo_weight,
-                HT.deadline,
-                HD.points,
-                HD.handled,
-                HP.presences
-            FROM Student S
-            JOIN Course C
-            JOIN hasWeights HW ON C.id = HW.course_id
-            LEFT JOIN hasTodo HT ON C.id = HT.course_id AND HW.exam_type_id = HT.exam_type_id
-            LEFT JOIN hasDone HD ON S.id = HD.student_id AND HT.todo_id = HD.todo_id
-            LEFT JOIN hasPresences HP ON S.id = HP.student_id AND C.id = HP.course_id AND HW.exam_type_id = HP.exam_type_id
-            ORDER BY student_id, course_id, exam_type_id, todo_id;
-        """
-        
-        data = pd.read_sql_query(query, conn)
-        conn.close()
-        print("Database fetching complete.")
-    else:
+    if backend not in CLASSIFICATION_BACKENDS:
+        raise ValueError(f"Unknown classification backend {backend!r}, expected one of {CLASSIFICATION_BACKENDS}")
+
+    print(f"Trying to connect to {db_file}...")
+    conn = shared_connection(db_file)
+    if not conn:
         print("Database operation aborted.")
+        return None
 
     try:
-        final_data = compute_metrics(data)
+        weights = get_init_data()
+        refresh_started = conn.execute("SELECT julianday('now');").fetchone()[0]
+
+        if workers and workers > 1:
+            final_data = compute_metrics_parallel(conn, db_file, workers, chunk_students or CHUNK_STUDENTS, weights, backend)
+        elif backend == 'sql':
+            final_data = compute_metrics_sql(conn, weights=weights)
+        elif chunk_students or memory_limit_mb:
+            final_data = compute_metrics_chunked(conn, chunk_students or CHUNK_STUDENTS, memory_limit_mb, weights)
+        else:
+            data = read_classification_frame(conn)
+            print("Database fetching complete.")
+            final_data = compute_metrics(data, weights)
+
+        if materialize:
+            write_attendance_stats(conn, final_data, weights, refresh_started)
+
+    except Exception:
+        print("Exception thrown while computing metrics in classification.py/compute_metrics() ")
+        raise
 
-        to_show = 20
-        print(f"Preview {to_show} lines from dataframe with relevant metrics")
-        print(final_data.head(to_show))
+    to_show = 20
+    print(f"Preview {to_show} lines from dataframe with relevant metrics")
+    print(final_data.head(to_show))
+
+    return final_data
+
+
+# AttendanceStats materialization
+# A student's rows are recomputed when any of their hasDone / hasPresences rows changed after the last
+# refresh (StudentUpdates stamps). The delay/bonus sequence spans all of a student's courses, so the
+# student, not the (student, course) pair, is the unit of recomputation. A hasTodo / hasWeights change
+# (CourseUpdates) affects every student and triggers a full rebuild.
+REFRESH_NAME = 'AttendanceStats'
+
+DIRTY_STUDENTS_QUERY = "SELECT DISTINCT student_id FROM StudentUpdates WHERE updated_at >= ?;"
+DIRTY_STUDENTS_WHERE = "WHERE S.id IN (SELECT student_id FROM StudentUpdates WHERE updated_at >= ?)"
+STUDENT_STATS_DELETE = "DELETE FROM AttendanceStats WHERE student_id = ?;"
+
+
+def compute_metrics_where(conn, where="", params=(), weights=None, backend='sql') -> pd.DataFrame:
+    if backend == 'sql':
+        return compute_metrics_sql(conn, where, params, weights)
+
+    return compute_metrics(read_classification_frame(conn, where, params), weights)
+
+
+@instrumented('classification.refresh')
+def refresh_attendance_stats(conn, full=False, backend='sql') -> int:
+    refresh_started = conn.execute("SELECT julianday('now');").fetchone()[0]
+    state = conn.execute("SELECT refreshed_at, w_presence, w_todos FROM RefreshState WHERE name = ?;",
+                         (REFRESH_NAME,)).fetchone()
+
+    if state is not None and not full:
+        watermark, w_presence, w_todos = state
+        courses_changed = conn.execute("SELECT COUNT(*) FROM CourseUpdates WHERE updated_at >= ?;",
+                                       (watermark,)).fetchone()[0]
+        full = courses_changed > 0
+        weights = (w_presence, w_todos)
+    else:
+        full = True
+        weights = state[1:] if state is not None else get_init_data()
+
+    if full:
+        final_data = compute_metrics_where(conn, weights=weights, backend=backend)
+        student_ids = None
+    else:
+        # Dirty students read once, before the metrics: rows stamped later are past refresh_started and are
+        # picked up by the next refresh. Students recomputed from the later stamps are replaced as well
+        student_ids = [row[0] for row in conn.execute(DIRTY_STUDENTS_QUERY, (watermark,))]
+        final_data = compute_metrics_where(conn, DIRTY_STUDENTS_WHERE, (watermark,), weights, backend)
+        student_ids = sorted(set(student_ids).union(final_data['student_id'].astype(int)))
+
+    write_attendance_stats(conn, final_data, weights, refresh_started, student_ids)
+
+    return len(final_data)
 
-        return final_data
-    
-    except:
-        print("Exception thrown while computing metrics in classification.py/compute_metrics() ")
 
-    return final_data
\ No newline at end of file
+# Replaces AttendanceStats rows (all of them, or only those of student_ids) and moves the watermark to
+# refresh_started, the database time read before the metrics were fetched
+@instrumented('classification.materialize')
+def write_attendance_stats(conn, final_data, weights, refresh_started, student_ids=None):
+    rows = final_data[['course_id', 'student_id', 'PunctajComponentaExamene', 'ScorPrezenteExam',
+                       'Ajustare_Delay/Bonus', 'NotaAproximativa', 'Class']]
+
+    try:
+        if student_ids is None:
+            conn.execute("DELETE FROM AttendanceStats;")
+        else:
+            conn.executemany(STUDENT_STATS_DELETE, ((student_id,) for student_id in student_ids))
+
+        conn.executemany("""
+            INSERT INTO AttendanceStats (course_id, student_id, todo_score, presence_score, adjustment, final_grade, success)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+        """, rows.itertuples(index=False, name=None))
+
+        conn.execute("INSERT OR REPLACE INTO RefreshState VALUES (?, ?, ?, ?);", (REFRESH_NAME, refresh_started, *weights))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print(f"\t{'Full' if student_ids is None else 'Incremental'} refresh: {len(rows):,} (student, course) rows "
+          f"materialized for {rows['student_id'].nunique():,} students")
+
+
+# Materializes a classification computed earlier (restored from the stage cache) unless AttendanceStats already
+# holds it: as many rows, written with the same weights. Returns whether the table was rewritten
+def ensure_attendance_stats(conn, final_data, weights) -> bool:
+    count = conn.execute("SELECT COUNT(*) FROM AttendanceStats;").fetchone()[0]
+    state = conn.execute("SELECT w_presence, w_todos FROM RefreshState WHERE name = ?;", (REFRESH_NAME,)).fetchone()
+
+    if count == len(final_data) and state is not None and tuple(map(float, state)) == tuple(map(float, weights)):
+        return False
+
+    refresh_started = conn.execute("SELECT julianday('now');").fetchone()[0]
+    write_attendance_stats(conn, final_data, weights, refresh_started)
+    return True
+
+
+def run_db_refresh(full=False, backend='sql'):
+    print("\n\n>>> Refreshing AttendanceStats <<<\n")
+
+    print(f"Trying to connect to {DB_NAME}...")
+    conn = shared_connection(DB_NAME)
+    if conn:
+        return refresh_attendance_stats(conn, full, backend)
+    else:
+        print("Database operation aborted.")
@@ -0,0 +1,160 @@
+import os
+import time
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from naive_bayes import NaiveBayes, CLASSES, encode_classes
+from tokenization import TOKEN_VOCABULARY
+
+CV_FOLDS = 5
+CV_REPEATS = 1
+CV_SEED = 42
+
+
+# Fold of every document for each repeat (repeats x documents): every class is shuffled on its own and
+# dealt round-robin over the folds, so each fold keeps the cohort's class proportions
+def stratified_folds(labels: np.ndarray, k=CV_FOLDS, repeats=CV_REPEATS, seed=CV_SEED) -> np.ndarray:
+    folds = np.empty((repeats, len(labels)), dtype=np.int16)
+
+    for repeat in range(repeats):
+        rng = np.random.default_rng([seed, repeat])
+        for label in np.unique(labels):
+            members = rng.permutation(np.flatnonzero(labels == label))
+            folds[repeat, members] = np.arange(len(members)) % k
+
+    return folds
+
+
+# Token codes, class indices and fold assignments packed in one shared memory block; workers attach
+# to it by name instead of receiving the documents through pickling
+class SharedDataset:
+    def __init__(self, codes: np.ndarray, labels: np.ndarray, folds: np.ndarray):
+        specs = [('codes', codes), ('labels', labels), ('folds', folds)]
+        size = sum(array.nbytes for _, array in specs)
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.layout = []
+
+        offset = 0
+        for name, array in specs:
+            self.layout.append((name, array.dtype.str, array.shape, offset))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf, offset=offset)[...] = array
+            offset += array.nbytes
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_arrays(shm, layout) -> dict:
+    return {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in layout}
+
+
+# Worker state, set once per process
+_worker = None
+
+def init_worker(shm_name, layout, vocabulary, classes):
+    global _worker
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker = {'shm': shm, 'arrays': attach_arrays(shm, layout), 'vocabulary': vocabulary, 'classes': classes}
+
+
+def evaluate_fold(task):
+    repeat, fold = task
+    arrays = _worker['arrays']
+    codes, labels = arrays['codes'], arrays['labels']
+    test_mask = arrays['folds'][repeat] == fold
+
+    start = time.perf_counter()
+    model = NaiveBayes(_worker['vocabulary'], _worker['classes']).fit(codes[~test_mask], labels[~test_mask])
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predicted = model.predict_codes(codes[test_mask])
+    predict_time = time.perf_counter() - start
+
+    n_classes = len(_worker['classes'])
+    confusion = np.bincount(labels[test_mask].astype(np.int64) * n_classes + predicted,
+                            minlength=n_classes * n_classes).reshape(n_classes, n_classes)
+
+    return {
+        'repeat': repeat,
+        'fold': fold,
+        'train_size': int(np.count_nonzero(~test_mask)),
+        'test_size': int(np.count_nonzero(test_mask)),
+        'confusion': confusion.tolist(),
+        'fit_time_s': fit_time,
+        'predict_time_s': predict_time,
+    }
+
+
+# Accuracy and per-class precision / recall from a (true x predicted) confusion matrix; 0 when undefined
+def fold_metrics(confusion, classes=CLASSES) -> dict:
+    confusion = np.asarray(confusion, dtype=np.float64)
+    correct = np.diag(confusion)
+    predicted = confusion.sum(axis=0)
+    actual = confusion.sum(axis=1)
+
+    precision = np.divide(correct, predicted, out=np.zeros_like(correct), where=predicted > 0)
+    recall = np.divide(correct, actual, out=np.zeros_like(correct), where=actual > 0)
+
+    metrics = {'accuracy': correct.sum() / max(confusion.sum(), 1)}
+    for idx, label in enumerate(classes):
+        metrics[f'precision_{label}'] = precision[idx]
+        metrics[f'recall_{label}'] = recall[idx]
+
+    return metrics
+
+
+def cross_validate(codes: np.ndarray, labels: np.ndarray, k=CV_FOLDS, repeats=CV_REPEATS, seed=CV_SEED, workers=None,
+                   vocabulary=TOKEN_VOCABULARY, classes=CLASSES) -> dict:
+    class_indices = encode_classes(labels, classes).astype(np.int8) if np.asarray(labels).dtype.kind in 'OUS' \
+                    else np.asarray(labels, dtype=np.int8)
+    folds = stratified_folds(class_indices, k, repeats, seed)
+    tasks = [(repeat, fold) for repeat in range(repeats) for fold in range(k)]
+    workers = min(workers or os.cpu_count(), len(tasks))
+
+    start = time.perf_counter()
+    dataset = SharedDataset(np.ascontiguousarray(codes), class_indices, folds)
+    try:
+        initargs = (dataset.shm.name, dataset.layout, list(vocabulary), list(classes))
+        if workers <= 1:
+            init_worker(*initargs)
+            results = [evaluate_fold(task) for task in tasks]
+            _worker['shm'].close()
+        else:
+            with Pool(workers, initializer=init_worker, initargs=initargs) as pool:
+                results = pool.map(evaluate_fold, tasks)
+    finally:
+        dataset.close()
+    elapsed = time.perf_counter() - start
+
+    for result in results:
+        result.update(fold_metrics(result['confusion'], classes))
+
+    metric_names = ['accuracy'] + [f'{metric}_{label}' for label in classes for metric in ('precision', 'recall')]
+    aggregate = {name: {'mean': float(np.mean([result[name] for result in results])),
+                        'std': float(np.std([result[name] for result in results]))}
+                 for name in metric_names + ['fit_time_s', 'predict_time_s']}
+    aggregate['confusion'] = np.sum([result['confusion'] for result in results], axis=0).tolist()
+
+    return {'k': k, 'repeats': repeats, 'seed': seed, 'workers': workers, 'elapsed_s': elapsed,
+            'folds': results, 'aggregate': aggregate}
+
+
+def run_cross_validation(dataset, k=CV_FOLDS, repeats=CV_REPEATS, seed=CV_SEED, workers=None):
+    print(f"\n\n>>> Started {repeats} x stratified {k}-fold cross validation <<<\n")
+
+    report = cross_validate(dataset.codes, dataset.labels, k, repeats, seed, workers, classes=dataset.classes)
+
+    for result in report['folds']:
+        print(f"\trepeat {result['repeat']} fold {result['fold']}: accuracy {result['accuracy'] * 100:6.2f}%  "
+              f"({result['test_size']:,} documents, fit {result['fit_time_s'] * 1000:.1f} ms, "
+              f"predict {result['predict_time_s'] * 1000:.1f} ms)")
+
+    for name, values in report['aggregate'].items():
+        if name != 'confusion':
+            print(f"\t{name:<24} {values['mean']:.4f} +- {values['std']:.4f}")
+    print(f"Cross validation finished in {report['elapsed_s']:.2f}s with {report['workers']} worker(s)")
+
+    return report
@@ -3,10 +3,13 @@ import random
 import sqlite3
 import importlib.util
 from datetime import datetime, timedelta
-from dbconfig import create_connection, DB_NAME
+from dbconfig import shared_connection, close_connections, apply_pragmas, epoch_day, sql_format_epoch_day, DB_NAME
+from instrumentation import instrumented, span
 
 basefile_dir = os.path.abspath(os.path.dirname(__file__)) if '__file__' in locals() else '/app_directory'
 
+STUDENT_COUNT = 200
+
 
 def seed_examType(conn):
     print(">> Seeding table ExamType")
@@ -26,13 +29,23 @@ def seed_examType(conn):
         print(f"\tAn error occurred during ExamType seeding: {e}")
 
 
-def seed_student(conn):    
-    spec = importlib.util.spec_from_file_location("data", "data/student_names.py")
+def load_student_names():
+    spec = importlib.util.spec_from_file_location("data", f"{basefile_dir}/data/student_names.py")
     module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(module)
 
-    FIRST_NAMES = module.FIRST_NAMES
-    LAST_NAMES = module.SURNAMES
+    return module.FIRST_NAMES, module.SURNAMES
+
+
+def load_course_names():
+    courses_file = f"{basefile_dir}/data/course_names.csv"
+
+    with open(courses_file, 'r', encoding='utf-8') as f:
+        return [name.strip() for name in f.readlines() if name.strip()]
+
+
+def seed_student(conn, student_count=STUDENT_COUNT):
+    FIRST_NAMES, LAST_NAMES = load_student_names()
     
     print(">> Seeding table Student")
     
@@ -41,7 +54,7 @@ def seed_student(conn):
     try:
         cursor = conn.cursor()
         
-        for _ in range (0, 200):
+        for _ in range (0, student_count):
             student_name = " ".join([random.choice(LAST_NAMES), random.choice(FIRST_NAMES)]).strip()
             cursor.execute(sql, (student_name,))
             print(f"\tInserted Student: {student_name}")
@@ -179,7 +192,7 @@ def seed_hasTodo(conn):
                     weight_to_use = random.choice(available_weights)
                 
                 max_points = random.choice(allowed_max_points)
-                deadline = get_random_date(START_DATE, END_DATE)
+                deadline = epoch_day(get_random_date(START_DATE, END_DATE))
 
                 record = (course_id, exam_type_id, max_points, weight_to_use, deadline)
                 course_todos.append(record)
@@ -207,8 +220,6 @@ def seed_hasDone(conn):
         VALUES (?, ?, ?, ?);
     """
 
-    DATE_FORMAT = "%d.%m.%Y"
-
     try:
         cursor = conn.cursor()
 
@@ -225,12 +236,10 @@ def seed_hasDone(conn):
         for student_id in students:
             done_todos = []
 
-            for (todo_id, todo_max_points, deadline_str) in todos:
-                deadline_date = datetime.strptime(deadline_str, DATE_FORMAT).date()
-                start_date_str = (deadline_date - timedelta(days=30)).strftime(DATE_FORMAT)
-                end_date_str = (deadline_date + timedelta(days=30)).strftime(DATE_FORMAT)
-
-                handled = random.choice([None, get_random_date(start_date_str, end_date_str)])
+            # Deadlines are epoch days: a handled date within 30 days of the deadline is integer arithmetic
+            # (the same draw as get_random_date over that window)
+            for (todo_id, todo_max_points, deadline) in todos:
+                handled = random.choice([None, deadline + random.randrange(-30, 31)])
                 points = 0 if handled is None else random.randint(0, todo_max_points)
 
                 record = (student_id, todo_id, points, handled)
@@ -292,21 +301,22 @@ def seed_hasPresences(conn):
         print(f"\tAn error occurred during hasPresences seeding: {e}")
 
 import pandas as pd
-def run_db_seed():
+@instrumented('seed')
+def run_db_seed(student_count=STUDENT_COUNT):
     print(">>> Seeding database <<<")
 
     print(f"Trying to connect to {DB_NAME}...")
-    conn = create_connection(DB_NAME)
+    conn = shared_connection(DB_NAME)
     if conn:
         seed_examType(conn)
-        seed_student(conn)
+        seed_student(conn, student_count)
         seed_course(conn)
         seed_hasWeights(conn)
         seed_hasTodo(conn)
         seed_hasDone(conn)
         seed_hasPresences(conn)
 
-        query = """
+        query = f"""
             SELECT
                 S.id AS student_id,
                 HW.course_id AS course_id,
@@ -316,9 +326,9 @@ def run_db_seed():
                 HT.todo_id AS todo_id,
                 HT.max_points,
                 HT.weight AS todo_weight,
-                HT.deadline,
+                {sql_format_epoch_day('HT.deadline')} AS deadline,
                 HD.points,
-                HD.handled,
+                {sql_format_epoch_day('HD.handled')} AS handled,
                 HP.presences
             FROM Student S
             JOIN Course C
@@ -335,7 +345,325 @@ def run_db_seed():
         print(f"Preview {to_show} lines from raw dataframe")
         print(data.head(to_show))
 
-        conn.close()
         print("Database seeding complete.")
     else:
-        print("Database operation aborted.")
\ No newline at end of file
+        print("Database operation aborted.")
+
+
+# Bulk seeding mode: batched numpy generation, executemany inside a single transaction
+# Student shards are generated in a process pool from per-shard seeds derived from one master seed
+# and written by a single writer in shard order, so a master seed always yields the same database
+import time
+import argparse
+import numpy as np
+from collections import deque
+from datetime import date
+from multiprocessing import Pool
+from dbconfig import setup_database, STAMP_TRIGGERS, INDEXES
+
+BULK_BATCH_SIZE = 5000
+BULK_PRAGMAS = [
+    "PRAGMA foreign_keys = OFF;",
+    "PRAGMA journal_mode = MEMORY;",
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA cache_size = -262144;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA locking_mode = EXCLUSIVE;",
+]
+
+SEED_START_DATE = date(2025, 10, 1)
+SEED_END_DATE = date(2026, 2, 1)
+HANDLED_WINDOW_DAYS = 30
+
+
+# Every epoch day a deadline or handled date can take, indexed by day offset from SEED_START_DATE - HANDLED_WINDOW_DAYS
+# (Python ints, so that tolist() hands sqlite3 plain integers)
+def seed_days():
+    first_day = epoch_day(SEED_START_DATE) - HANDLED_WINDOW_DAYS
+    last_day = epoch_day(SEED_END_DATE) + HANDLED_WINDOW_DAYS
+
+    return np.array(list(range(first_day, last_day + 1)), dtype=object)
+
+
+# Course-level tables use spawn key (0,), student shard k uses (1, k)
+def course_rng(entropy):
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(0,)))
+
+
+def shard_rng(entropy, shard_index):
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(1, shard_index)))
+
+
+def bulk_courses(course_count=None):
+    names = load_course_names()
+    if course_count is None:
+        return names
+
+    # Extra courses reuse the CSV names with a numeric suffix to keep them UNIQUE
+    return [names[idx % len(names)] if idx < len(names) else f"{names[idx % len(names)]} ({idx // len(names) + 1})"
+            for idx in range(course_count)]
+
+
+def bulk_weights(rng, course_ids, exam_type_ids):
+    allowed_presences = [0, 5, 7, 10, 14]
+    allowed_percentages = [[50, 60, 70], [20, 30]]
+
+    records = []
+    for course_id in course_ids:
+        total_weight = 100
+        for idx, exam_type_id in enumerate(exam_type_ids):
+            required_presences = int(rng.choice(allowed_presences))
+            if idx < 2:
+                weight = int(rng.choice(allowed_percentages[idx]))
+                total_weight -= weight
+            else:
+                weight = total_weight
+            records.append((course_id, exam_type_id, weight, required_presences))
+
+    return records
+
+
+# Returns (records, deadline day offsets) for every todo
+def bulk_todos(rng, components):
+    allowed_max_points = [5, 10]
+    allowed_weight = [25, 50, 100]
+    days_in_interval = (SEED_END_DATE - SEED_START_DATE).days
+
+    records, deadline_days = [], []
+    for course_id, exam_type_id, _, _ in components:
+        current_weight = 100
+        while current_weight > 0:
+            available_weights = [w for w in allowed_weight if w <= current_weight]
+            if current_weight <= min(allowed_weight) or not available_weights:
+                weight_to_use = current_weight
+            else:
+                weight_to_use = int(rng.choice(available_weights))
+
+            deadline_day = int(rng.integers(0, days_in_interval + 1))
+            records.append([course_id, exam_type_id, int(rng.choice(allowed_max_points)), weight_to_use, deadline_day])
+            deadline_days.append(deadline_day)
+            current_weight -= weight_to_use
+
+    return records, np.array(deadline_days)
+
+
+# Read-only generation context shared by every shard (set once per worker process)
+_shard_context = None
+
+def init_shard_context(context):
+    global _shard_context
+    _shard_context = context
+
+
+# One block of students: names, hasDone (points, handled date index or -1) and hasPresences as compact arrays
+def generate_shard(shard_index):
+    ctx = _shard_context
+    rng = shard_rng(ctx['entropy'], shard_index)
+
+    first_id = shard_index * ctx['batch_size'] + 1
+    student_ids = np.arange(first_id, min(first_id + ctx['batch_size'], ctx['student_count'] + 1), dtype=np.int64)
+
+    names = np.char.add(np.char.add(rng.choice(ctx['last_names'], len(student_ids)), ' '),
+                        rng.choice(ctx['first_names'], len(student_ids)))
+
+    # hasDone: half of the todos are never handled, the rest within +-30 days of the deadline
+    done_shape = (len(student_ids), len(ctx['max_points']))
+    is_handled = rng.random(done_shape) < 0.5
+    handled_days = ctx['deadline_days'] + HANDLED_WINDOW_DAYS + \
+                   rng.integers(-HANDLED_WINDOW_DAYS, HANDLED_WINDOW_DAYS + 1, done_shape)
+    handled = np.where(is_handled, handled_days, -1).astype(np.int16)
+    points = np.where(is_handled, rng.integers(0, ctx['max_points'] + 1, done_shape), 0).astype(np.int8)
+
+    # hasPresences: same rule as seed_hasPresences, components requiring more than 7 presences get none
+    required_presences = ctx['required_presences']
+    presence_shape = (len(student_ids), len(required_presences))
+    upper = np.where(required_presences <= 7, required_presences + rng.integers(0, 8, presence_shape), 0)
+    presences = rng.integers(0, upper + 1, presence_shape).astype(np.int8)
+
+    return student_ids, names, points, handled, presences
+
+
+# Yields shards in order; at most 2 x workers shards are in flight to bound memory
+def generate_shards(context, shard_count, workers):
+    if workers <= 1:
+        init_shard_context(context)
+        for shard_index in range(shard_count):
+            yield generate_shard(shard_index)
+        return
+
+    with Pool(workers, initializer=init_shard_context, initargs=(context,)) as pool:
+        pending = deque()
+        next_shard = 0
+
+        while pending or next_shard < shard_count:
+            while next_shard < shard_count and len(pending) < 2 * workers:
+                pending.append(pool.apply_async(generate_shard, (next_shard,)))
+                next_shard += 1
+
+            yield pending.popleft().get()
+
+
+class SeedReport:
+    def __init__(self):
+        self.tables = {}
+
+    def add(self, table, rows, elapsed):
+        total_rows, total_elapsed = self.tables.get(table, (0, 0.0))
+        self.tables[table] = (total_rows + rows, total_elapsed + elapsed)
+
+    def print(self, elapsed):
+        for table, (rows, table_elapsed) in self.tables.items():
+            print(f"\t{table:<14} {rows:>12,} rows  {table_elapsed:8.2f}s  {rows / max(table_elapsed, 1e-9):>12,.0f} rows/s")
+
+        total_rows = sum(rows for rows, _ in self.tables.values())
+        print(f"\t{'Total':<14} {total_rows:>12,} rows  {elapsed:8.2f}s  {total_rows / max(elapsed, 1e-9):>12,.0f} rows/s")
+
+
+def bulk_insert(cursor, report, table, sql, rows):
+    with span(f'seed.insert.{table}') as step:
+        start = time.perf_counter()
+        before = cursor.connection.total_changes
+        cursor.executemany(sql, rows)
+        step.rows = inserted = cursor.connection.total_changes - before
+
+    report.add(table, inserted, time.perf_counter() - start)
+
+
+def bulk_seed(conn, student_count=STUDENT_COUNT, course_count=None, batch_size=BULK_BATCH_SIZE, seed=None, workers=1):
+    # The same (seed, batch_size) pair reproduces the database whatever the worker count
+    entropy = np.random.SeedSequence(seed).entropy
+    print(f">> Bulk seeding {student_count:,} students (master seed {entropy}, {workers} worker(s))")
+
+    rng = course_rng(entropy)
+    report = SeedReport()
+    days = seed_days()
+    FIRST_NAMES, LAST_NAMES = load_student_names()
+
+    for pragma in BULK_PRAGMAS:
+        conn.execute(pragma)
+
+    cursor = conn.cursor()
+    start = time.perf_counter()
+
+    try:
+        cursor.execute("BEGIN;")
+
+        # A freshly generated database carries no update stamps; indexes are rebuilt once after the load
+        for trigger in STAMP_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+        for index in INDEXES:
+            cursor.execute(f"DROP INDEX IF EXISTS {index};")
+
+        exam_types = ['Course', 'Laboratory', 'Seminary']
+        bulk_insert(cursor, report, 'ExamType', 'INSERT INTO ExamType (id, name) VALUES (?, ?);',
+                    enumerate(exam_types, start=1))
+        exam_type_ids = list(range(1, len(exam_types) + 1))
+
+        courses = bulk_courses(course_count)
+        bulk_insert(cursor, report, 'Course', 'INSERT INTO Course (id, name) VALUES (?, ?);',
+                    enumerate(courses, start=1))
+        course_ids = list(range(1, len(courses) + 1))
+
+        components = bulk_weights(rng, course_ids, exam_type_ids)
+        bulk_insert(cursor, report, 'hasWeights',
+                    'INSERT INTO hasWeights (course_id, exam_type_id, weight, required_presences) VALUES (?, ?, ?, ?);',
+                    components)
+
+        todos, deadline_days = bulk_todos(rng, components)
+        todo_ids = np.arange(1, len(todos) + 1)
+        bulk_insert(cursor, report, 'hasTodo',
+                    'INSERT INTO hasTodo (todo_id, course_id, exam_type_id, max_points, weight, deadline) VALUES (?, ?, ?, ?, ?, ?);',
+                    ([todo_id, *todo[:4], days[todo[4] + HANDLED_WINDOW_DAYS]] for todo_id, todo in zip(todo_ids.tolist(), todos)))
+
+        context = {
+            'entropy': entropy,
+            'batch_size': batch_size,
+            'student_count': student_count,
+            'first_names': FIRST_NAMES,
+            'last_names': LAST_NAMES,
+            'max_points': np.array([todo[2] for todo in todos]),
+            'deadline_days': deadline_days,
+            'required_presences': np.array([component[3] for component in components]),
+        }
+        component_ids = np.array([component[:2] for component in components])
+        handled_days = np.append(days, None)
+
+        shard_count = (student_count + batch_size - 1) // batch_size
+        for student_ids, names, points, handled, presences in generate_shards(context, shard_count, workers):
+            bulk_insert(cursor, report, 'Student', 'INSERT INTO Student (id, name) VALUES (?, ?);',
+                        zip(student_ids.tolist(), names.tolist()))
+
+            # handled == -1 picks the trailing None
+            bulk_insert(cursor, report, 'hasDone',
+                        'INSERT INTO hasDone (student_id, todo_id, points, handled) VALUES (?, ?, ?, ?);',
+                        zip(np.repeat(student_ids, len(todo_ids)).tolist(),
+                            np.tile(todo_ids, len(student_ids)).tolist(),
+                            points.ravel().tolist(),
+                            handled_days[handled.ravel()].tolist()))
+
+            bulk_insert(cursor, report, 'hasPresences',
+                        'INSERT INTO hasPresences (student_id, course_id, exam_type_id, presences) VALUES (?, ?, ?, ?);',
+                        zip(np.repeat(student_ids, len(component_ids)).tolist(),
+                            np.tile(component_ids[:, 0], len(student_ids)).tolist(),
+                            np.tile(component_ids[:, 1], len(student_ids)).tolist(),
+                            presences.ravel().tolist()))
+
+            print(f"\tSeeded students {student_ids[0]:,} - {student_ids[-1]:,}")
+
+        index_start = time.perf_counter()
+        for index_sql in INDEXES.values():
+            cursor.execute(index_sql)
+        cursor.execute("ANALYZE;")
+        report.add('(indexes)', 0, time.perf_counter() - index_start)
+
+        for trigger_sql in STAMP_TRIGGERS.values():
+            cursor.execute(trigger_sql)
+
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        # Back to the shared connection settings (WAL, normal locking) for the stages that follow
+        conn.execute("PRAGMA locking_mode = NORMAL;")
+        apply_pragmas(conn)
+
+    elapsed = time.perf_counter() - start
+    print("\tBulk seeding complete.")
+    report.print(elapsed)
+
+    return report
+
+
+@instrumented('seed.bulk', rows=lambda report: sum(rows for rows, _ in report.tables.values()))
+def run_db_bulk_seed(student_count=STUDENT_COUNT, course_count=None, batch_size=BULK_BATCH_SIZE, seed=None, workers=1, db_file=DB_NAME):
+    print(">>> Bulk seeding database <<<")
+
+    # Rebuilt in place (same file), so open readers (scoring service, ConnectionManager readers) see the new data
+    # through PRAGMA data_version / schema_version instead of keeping the unlinked file. The reset vacuums the
+    # emptied file, so the result does not depend on the previous database
+    close_connections(db_file)
+
+    print(f"Trying to connect to {db_file}...")
+    conn = shared_connection(db_file)
+    if conn:
+        setup_database(conn, reset=True)
+        return bulk_seed(conn, student_count, course_count, batch_size, seed, workers)
+    else:
+        print("Database operation aborted.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recreates the database and bulk seeds it at a configurable scale")
+    parser.add_argument('--students', type=int, default=STUDENT_COUNT)
+    parser.add_argument('--courses', type=int, default=None, help="defaults to every course in data/course_names.csv")
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE, help="students per shard")
+    parser.add_argument('--seed', type=int, default=None, help="master seed, printed when omitted")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--db', default=DB_NAME)
+    args = parser.parse_args()
+
+    run_db_bulk_seed(args.students, args.courses, args.batch_size, args.seed, args.workers, args.db)
+    close_connections()
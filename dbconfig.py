@@ -1,24 +1,56 @@
+import os
 import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from instrumentation import connection_factory, instrumented
 
 DB_NAME = 'data/student_stats.db'
 
-SCHEMA_SQL = """
-    CREATE TABLE ExamType (
+# hasTodo.deadline / hasDone.handled are INTEGER epoch days (days since 1970-01-01) from schema version 5,
+# so they sort and subtract in SQL; dd.mm.yyyy is only an input / display format
+DATE_FORMAT = "%d.%m.%Y"
+EPOCH = date(1970, 1, 1)
+EPOCH_JULIANDAY = 2440587.5
+
+
+# date or dd.mm.yyyy string -> epoch day
+def epoch_day(value) -> int:
+    if isinstance(value, str):
+        value = datetime.strptime(value, DATE_FORMAT).date()
+    return (value - EPOCH).days
+
+
+def format_epoch_day(day) -> str:
+    return (EPOCH + timedelta(days=day)).strftime(DATE_FORMAT)
+
+
+# dd.mm.yyyy TEXT column -> epoch day (NULL stays NULL), for databases created before version 5
+def sql_text_epoch_day(column: str) -> str:
+    return f"CAST(julianday(substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2)) - {EPOCH_JULIANDAY} AS INTEGER)"
+
+
+# Epoch day column -> dd.mm.yyyy TEXT (NULL stays NULL), for previews
+def sql_format_epoch_day(column: str) -> str:
+    return f"strftime('%d.%m.%Y', {column} * 86400, 'unixepoch')"
+
+# Versioned migrations, applied in order and tracked by PRAGMA user_version
+BASE_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS ExamType (
         id      INTEGER PRIMARY KEY,
         name    TEXT NOT NULL UNIQUE
     );
 
-    CREATE TABLE Student (
+    CREATE TABLE IF NOT EXISTS Student (
         id      INTEGER PRIMARY KEY,
         name    TEXT NOT NULL
     );
 
-    CREATE TABLE Course (
+    CREATE TABLE IF NOT EXISTS Course (
         id      INTEGER PRIMARY KEY,
         name    TEXT NOT NULL UNIQUE
     );
 
-    CREATE TABLE hasWeights (
+    CREATE TABLE IF NOT EXISTS hasWeights (
         course_id           INTEGER NOT NULL,
         exam_type_id        INTEGER NOT NULL,
         weight              REAL NOT NULL,
@@ -29,7 +61,7 @@ SCHEMA_SQL = """
         FOREIGN KEY (exam_type_id) REFERENCES ExamType(id)
     );
 
-    CREATE TABLE hasTodo (
+    CREATE TABLE IF NOT EXISTS hasTodo (
         todo_id                 INTEGER PRIMARY KEY,
         course_id               INTEGER NOT NULL,
         exam_type_id            INTEGER NOT NULL,
@@ -41,7 +73,7 @@ SCHEMA_SQL = """
         FOREIGN KEY (exam_type_id) REFERENCES ExamType(id)
     );
 
-    CREATE TABLE hasDone (
+    CREATE TABLE IF NOT EXISTS hasDone (
         student_id  INTEGER NOT NULL,
         todo_id     INTEGER NOT NULL,
         points      REAL,
@@ -52,7 +84,7 @@ SCHEMA_SQL = """
         FOREIGN KEY (todo_id) REFERENCES hasTodo(todo_id)
     );
 
-    CREATE TABLE hasPresences (
+    CREATE TABLE IF NOT EXISTS hasPresences (
         student_id      INTEGER NOT NULL,
         course_id       INTEGER NOT NULL,
         exam_type_id    INTEGER NOT NULL,
@@ -63,58 +95,261 @@ SCHEMA_SQL = """
         FOREIGN KEY (course_id)     REFERENCES Course(id),
         FOREIGN KEY (exam_type_id)  REFERENCES ExamType(id)
     );
+    """
 
-    CREATE TABLE AttendanceStats (
-        course_id   INTEGER NOT NULL,
-        student_id  INTEGER NOT NULL,
-        final_grade REAL,               -- The official final numeric grade (e.g., 7.5)
-        success     TEXT,               -- The categorical outcome (e.g., 'Pass', 'Fail')
+STAMPS_SCHEMA_SQL = """
+    -- Last modification time (julianday) of the rows feeding a student's / course's metrics
+    CREATE TABLE IF NOT EXISTS StudentUpdates (
+        student_id  INTEGER PRIMARY KEY,
+        updated_at  REAL NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS CourseUpdates (
+        course_id   INTEGER PRIMARY KEY,
+        updated_at  REAL NOT NULL
+    );
+    """
+
+# Triggers stamping StudentUpdates / CourseUpdates whenever a metric source row changes
+STAMP_TRIGGERS = {
+    f"{table}_{event.lower()}_stamp": f"""
+    CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_stamp AFTER {event} ON {table}
+    BEGIN
+        INSERT OR REPLACE INTO {target} VALUES ({row}.{key}, julianday('now'));
+    END;
+    """
+    for table, target, key in [('hasDone', 'StudentUpdates', 'student_id'),
+                               ('hasPresences', 'StudentUpdates', 'student_id'),
+                               ('hasTodo', 'CourseUpdates', 'course_id'),
+                               ('hasWeights', 'CourseUpdates', 'course_id')]
+    for event, row in [('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')]
+}
+
+# AttendanceStats only holds derived data, so the migration rebuilds it (and its refresh watermark)
+ATTENDANCE_SCHEMA_SQL = """
+    DROP TABLE IF EXISTS RefreshState;
+    DROP TABLE IF EXISTS AttendanceStats;
+
+    CREATE TABLE IF NOT EXISTS AttendanceStats (
+        course_id       INTEGER NOT NULL,
+        student_id      INTEGER NOT NULL,
+        todo_score      REAL,           -- PunctajComponentaExamene
+        presence_score  REAL,           -- ScorPrezenteExam
+        adjustment      REAL,           -- Ajustare_Delay/Bonus
+        final_grade     REAL,           -- The official final numeric grade (e.g., 7.5)
+        success         TEXT,           -- The categorical outcome (e.g., 'Pass', 'Fail')
         
         PRIMARY KEY (course_id, student_id),
         FOREIGN KEY (course_id)     REFERENCES Course(id),
         FOREIGN KEY (student_id)    REFERENCES Student(id)
     );
+
+    CREATE INDEX IF NOT EXISTS AttendanceStats_student ON AttendanceStats (student_id);
+
+    -- AttendanceStats refresh watermark (julianday) and the calculation weights it was built with
+    CREATE TABLE IF NOT EXISTS RefreshState (
+        name            TEXT PRIMARY KEY,
+        refreshed_at    REAL NOT NULL,
+        w_presence      REAL NOT NULL,
+        w_todos         REAL NOT NULL
+    );
     """
 
-# Connects to database origin file
-def create_connection(db_file):
+# Covering indexes for the classification join, the per-student point / range queries and the refresh
+INDEXES = {
+    'hasTodo_component': "CREATE INDEX IF NOT EXISTS hasTodo_component ON hasTodo (course_id, exam_type_id, todo_id, max_points, weight, deadline);",
+    'hasDone_student_cover': "CREATE INDEX IF NOT EXISTS hasDone_student_cover ON hasDone (student_id, todo_id, points, handled);",
+    'hasDone_todo': "CREATE INDEX IF NOT EXISTS hasDone_todo ON hasDone (todo_id);",
+    'hasPresences_cover': "CREATE INDEX IF NOT EXISTS hasPresences_cover ON hasPresences (student_id, course_id, exam_type_id, presences);",
+    'StudentUpdates_updated': "CREATE INDEX IF NOT EXISTS StudentUpdates_updated ON StudentUpdates (updated_at);",
+}
+
+# Converts the dd.mm.yyyy TEXT dates in place. The update stamp triggers are lifted meanwhile: the
+# dates keep their meaning, so no student / course is marked for recomputation
+DATE_COLUMNS = [('hasTodo', 'deadline', 'INTEGER NOT NULL DEFAULT 0', 'hasTodo_component'),
+                ('hasDone', 'handled', 'INTEGER', 'hasDone_student_cover')]
+
+EPOCH_DAY_DATES_SQL = "".join(
+    f"""
+    DROP TRIGGER IF EXISTS {table}_update_stamp;
+    DROP INDEX IF EXISTS {index};
+    ALTER TABLE {table} ADD COLUMN {column}_day {definition};
+    UPDATE {table} SET {column}_day = {sql_text_epoch_day(column)} WHERE {column} IS NOT NULL;
+    ALTER TABLE {table} DROP COLUMN {column};
+    ALTER TABLE {table} RENAME COLUMN {column}_day TO {column};
+    {STAMP_TRIGGERS[f'{table}_update_stamp']}
+    {INDEXES[index]}
+    """
+    for table, column, definition, index in DATE_COLUMNS
+) + "ANALYZE;"
+
+MIGRATIONS = [
+    (1, "Base tables", BASE_SCHEMA_SQL),
+    (2, "Update stamp tables and triggers", STAMPS_SCHEMA_SQL + "".join(STAMP_TRIGGERS.values())),
+    (3, "AttendanceStats components and RefreshState", ATTENDANCE_SCHEMA_SQL),
+    # ANALYZE statistics let the planner prefer the covering indexes over the primary key autoindexes
+    (4, "Covering indexes for the classification queries", "\n".join(INDEXES.values()) + "\nANALYZE;"),
+    (5, "Dates stored as integer epoch days", EPOCH_DAY_DATES_SQL),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+TABLES = ['RefreshState', 'StudentUpdates', 'CourseUpdates', 'AttendanceStats', 'hasPresences', 'hasDone', 'hasTodo', 'hasWeights', 'Course', 'ExamType', 'Student']
+
+# Applied to every connection; WAL lets readers run while a single writer commits
+CONNECTION_PRAGMAS = [
+    "PRAGMA foreign_keys = ON;",
+    "PRAGMA mmap_size = 268435456;",
+    "PRAGMA cache_size = -65536;",
+    "PRAGMA temp_store = MEMORY;",
+]
+WRITER_PRAGMAS = [
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+]
+
+# Prepared statements kept per connection (sqlite3's default is 128)
+STATEMENT_CACHE_SIZE = 256
+
+
+def apply_pragmas(conn, read_only=False):
+    for pragma in CONNECTION_PRAGMAS + ([] if read_only else WRITER_PRAGMAS):
+        conn.execute(pragma)
+
+
+# Connects to database origin file; read_only opens it through a mode=ro URI (scoring workers, audits)
+def create_connection(db_file, read_only=False):
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
-        conn.execute("PRAGMA foreign_keys = ON;")
+        if read_only:
+            # Readers are used by a single thread but may be closed by the one owning their manager
+            conn = sqlite3.connect(f"file:{os.path.abspath(db_file)}?mode=ro", uri=True, factory=connection_factory(),
+                                   cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(db_file, factory=connection_factory(), cached_statements=STATEMENT_CACHE_SIZE)
+        apply_pragmas(conn, read_only)
         return conn
     except sqlite3.Error as e:
         print(f"Failed to connect to database using connection string {db_file}: {e}")
 
+
+# One shared connection per pipeline run, plus thread-local read-only connections for concurrent readers
+class ConnectionManager:
+    def __init__(self, db_file=DB_NAME):
+        self.db_file = db_file
+        self._conn = None
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        if self._conn is None:
+            self._conn = create_connection(self.db_file)
+        return self._conn
+
+    def reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = create_connection(self.db_file, read_only=True)
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+        self._local = threading.local()
+
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(db_file=DB_NAME) -> ConnectionManager:
+    key = os.path.abspath(db_file)
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = ConnectionManager(db_file)
+        return _managers[key]
+
+
+# The pipeline's stages share get_manager(db_file).connection(); closed once at the end of the run
+def shared_connection(db_file=DB_NAME):
+    return get_manager(db_file).connection()
+
+
+def close_connections(db_file=None):
+    with _managers_lock:
+        keys = list(_managers) if db_file is None else [os.path.abspath(db_file)]
+        managers = [_managers.pop(key) for key in keys if key in _managers]
+    for manager in managers:
+        manager.close()
+
+# Applies every migration newer than the database's user_version, each one in its own transaction
+def migrate(conn):
+    current_version = conn.execute("PRAGMA user_version;").fetchone()[0]
+
+    for version, description, sql in MIGRATIONS:
+        if version <= current_version:
+            continue
+
+        try:
+            conn.executescript(f"BEGIN; {sql} PRAGMA user_version = {version}; COMMIT;")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            raise
+
+        print(f"\tApplied migration {version}: {description}")
+
+    return max(current_version, SCHEMA_VERSION)
+
 # Setup the database using SQLite instructions from schema
-def setup_database(conn):
+# Non-destructive by default: existing data is kept and only missing migrations are applied
+def setup_database(conn, reset=False):
     if conn is not None:
         try:
-            cursor = conn.cursor()
-            
-            tables = ['AttendanceStats', 'hasPresences', 'hasDone', 'hasTodo', 'hasWeights', 'Course', 'ExamType', 'Student']
-            for table in tables:
-                cursor.execute(f"DROP TABLE IF EXISTS {table}")
-            
-            # Recreates all tables
-            cursor.executescript(SCHEMA_SQL)
-            conn.commit()
-
-            print("Database schema created successfully.")
+            if reset:
+                cursor = conn.cursor()
+                for table in TABLES:
+                    cursor.execute(f"DROP TABLE IF EXISTS {table}")
+                # Planner statistics left by ANALYZE
+                cursor.execute("DROP TABLE IF EXISTS sqlite_stat1")
+                cursor.execute("PRAGMA user_version = 0;")
+                conn.commit()
+
+                # Releases the dropped tables' pages, so the rebuilt schema is laid out as in a new file
+                conn.execute("VACUUM;")
+
+            version = migrate(conn)
+            print(f"Database schema is up to date (version {version}).")
         except sqlite3.Error as e:
-            print(f"Failed to connect create the database schema: {e}")
+            print(f"Failed to migrate the database schema: {e}")
     else:
         print("Failed to connect to database")
 
-def run_db_setup():
-    print(">>> Setting up / Replacing database <<<")
+@instrumented('setup')
+def run_db_setup(reset=False):
+    print(f">>> Setting up {'/ Replacing ' if reset else ''}database <<<")
 
     print(f"Trying to connect to {DB_NAME}...")
-    conn = create_connection(DB_NAME)
+    conn = shared_connection(DB_NAME)
     
     if conn:
-        setup_database(conn)
-        conn.close()
+        setup_database(conn, reset)
         print("Database setup complete.")
     else:
         print("Database operation aborted.")
@@ -0,0 +1,300 @@
+import os
+import math
+import time
+import heapq
+import itertools
+import numpy as np
+from multiprocessing import Pool
+from naive_bayes import NaiveBayes, CLASSES, encode_classes, holdout_split
+from tokenization import TOKEN_BINS, TOKEN_VOCABULARY, tokenize
+from cross_validation import stratified_folds, CV_FOLDS, CV_SEED
+
+# Candidate thresholds per feature; the inclusive flag of each threshold position comes from TOKEN_BINS
+# The default grid holds 74,088 candidates (21 x 28 x 21 threshold pairs x 6 alphas)
+SEARCH_GRID = {
+    'PunctajComponentaExamene': [float(value) for value in np.arange(20, 90, 10)],
+    'ScorPrezenteExam': [float(value) for value in np.arange(20, 100, 10)],
+    'Ajustare_Delay/Bonus': [float(value) for value in np.arange(-3.0, 4.0, 1.0)],
+}
+SEARCH_ALPHAS = [0.01, 0.1, 0.5, 1.0, 2.0, 5.0]
+SEARCH_ITERATIONS = 2000
+SEARCH_SEED = 42
+
+# A search over more candidates fails before evaluating any of them
+SEARCH_MAX_CANDIDATES = 200_000
+
+# Candidates are generated and scored in batches of SEARCH_BATCH, only the top ones are kept
+SEARCH_BATCH = 4096
+
+# Share of the documents held out of the search: the winner's cross validated score is the maximum over
+# every candidate (biased upwards), its holdout score is not
+SEARCH_HOLDOUT = 0.2
+
+
+# Every threshold a feature can take, ordered so that a value passes a prefix of them:
+# (t, inclusive) is passed when value >= t, (t, exclusive) when value > t, and (t, True) comes before (t, False)
+def feature_cuts(values, flags):
+    return sorted({(float(value), inclusive) for value in values for inclusive in flags}, key=lambda cut: (cut[0], not cut[1]))
+
+
+# Number of cuts every document passes, from the sorted inclusive / exclusive threshold columns
+# (NaN passes all of them, so it lands in the top bin as in bin_feature)
+def cut_levels(column: np.ndarray, cuts) -> np.ndarray:
+    inclusive = np.array([value for value, flag in cuts if flag])
+    exclusive = np.array([value for value, flag in cuts if not flag])
+
+    levels = np.searchsorted(inclusive, column, side='right') + np.searchsorted(exclusive, column, side='left')
+    return np.where(np.isnan(column), len(cuts), levels)
+
+
+# Class counts per (level_1, ..., level_f, class) cell, one histogram per fold. This is the only pass over
+# the documents: a candidate's token / class counts are sums of histogram blocks, whatever the row count
+def level_histograms(levels, class_indices, folds, n_levels, n_classes) -> np.ndarray:
+    shape = (*n_levels, n_classes)
+    flat = np.ravel_multi_index((*levels, class_indices), shape)
+    n_folds = int(folds.max()) + 1
+
+    return np.stack([np.bincount(flat[folds == fold], minlength=int(np.prod(shape))).reshape(shape)
+                     for fold in range(n_folds)])
+
+
+# Worker state, set once per process
+_search = None
+
+def init_search(context):
+    global _search
+    _search = context
+
+
+# Candidate: per feature, the cut indices of its thresholds (increasing), plus alpha
+# Returns the cross validated accuracy
+def evaluate_candidate(candidate):
+    cut_indices, alpha = candidate
+    ctx = _search
+    histograms = ctx['histograms']
+
+    # (fold, bin_1, ..., bin_f, class) counts: a document falls in bin j of a feature when it passes j of its cuts
+    cells = histograms
+    for axis, indices in enumerate(cut_indices, start=1):
+        cells = np.add.reduceat(cells, np.concatenate([[0], np.asarray(indices) + 1]), axis=axis)
+
+    test_cells = cells
+    train_cells = cells.sum(axis=0, keepdims=True) - cells
+    n_features = len(cut_indices)
+
+    correct = 0
+    for fold in range(cells.shape[0]):
+        model = NaiveBayes(ctx['vocabulary'], ctx['classes'], alpha=alpha)
+
+        train = train_cells[fold]
+        model.class_count = train.reshape(-1, train.shape[-1]).sum(axis=0)
+        model.token_count = np.concatenate([
+            train.sum(axis=tuple(axis for axis in range(n_features) if axis != feature)).T
+            for feature in range(n_features)
+        ], axis=1)
+        model._update_log_prob()
+
+        predicted = model.predict_codes(ctx['cell_codes'])
+        test = test_cells[fold].reshape(-1, test_cells.shape[-1])
+        correct += test[np.arange(len(test)), predicted].sum()
+
+    return correct / ctx['n_documents']
+
+
+def candidate_token_bins(candidate, cuts, token_bins=TOKEN_BINS):
+    cut_indices, _ = candidate
+    return [(column, [cuts[feature][idx] for idx in indices], tokens)
+            for feature, ((column, _, tokens), indices) in enumerate(zip(token_bins, cut_indices))]
+
+
+# Valid cut indices of every feature; the grid is their product with the alphas
+def grid_cut_indices(cuts, token_bins):
+    return [[indices for indices in itertools.combinations(range(len(feature_cuts_)), len(thresholds))
+             if _valid_cut_indices(indices, feature_cuts_, thresholds)]
+            for feature_cuts_, (_, thresholds, _) in zip(cuts, token_bins)]
+
+
+def grid_candidates(per_feature, alphas):
+    for cut_indices in itertools.product(*per_feature):
+        for alpha in alphas:
+            yield cut_indices, alpha
+
+
+def random_candidates(cuts, token_bins, alphas, iterations, seed):
+    rng = np.random.default_rng(seed)
+    seen = set()
+
+    for _ in range(iterations * 10):
+        if len(seen) >= iterations:
+            break
+
+        cut_indices = []
+        for feature_cuts_, (_, thresholds, _) in zip(cuts, token_bins):
+            while True:
+                indices = tuple(sorted(rng.choice(len(feature_cuts_), len(thresholds), replace=False).tolist()))
+                if _valid_cut_indices(indices, feature_cuts_, thresholds):
+                    break
+            cut_indices.append(indices)
+
+        candidate = (tuple(cut_indices), float(rng.choice(alphas)))
+        if candidate not in seen:
+            seen.add(candidate)
+            yield candidate
+
+
+# Each threshold position keeps its inclusive flag and thresholds strictly increase
+def _valid_cut_indices(indices, cuts, thresholds):
+    values = [cuts[idx][0] for idx in indices]
+    return all(cuts[idx][1] == inclusive for idx, (_, inclusive) in zip(indices, thresholds)) and \
+           all(a < b for a, b in zip(values, values[1:]))
+
+
+# Scores a stream of candidates batch by batch and keeps the `top` best as (candidate, accuracy), best first;
+# ties go to the earlier candidate. Returns them with the number of candidates scored
+def score_candidates(candidates, context, workers, top, batch_size=SEARCH_BATCH):
+    ranked = []
+    scored = 0
+
+    pool = Pool(workers, initializer=init_search, initargs=(context,)) if workers > 1 else None
+    try:
+        while True:
+            batch = list(itertools.islice(candidates, batch_size))
+            if not batch:
+                break
+
+            if pool is not None:
+                scores = pool.map(evaluate_candidate, batch, chunksize=max(len(batch) // (4 * workers), 1))
+            else:
+                scores = [evaluate_candidate(candidate) for candidate in batch]
+
+            for candidate, score in zip(batch, scores):
+                entry = (score, -scored, candidate)
+                if len(ranked) < top:
+                    heapq.heappush(ranked, entry)
+                else:
+                    heapq.heappushpop(ranked, entry)
+                scored += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return [(candidate, float(score)) for score, _, candidate in sorted(ranked, reverse=True)], scored
+
+
+# Accuracy on the holdout documents of a model fitted on the search documents
+def holdout_accuracy(features, class_indices, search_idx, holdout_idx, token_bins, alpha) -> float:
+    codes = tokenize(features, token_bins)
+    model = NaiveBayes(TOKEN_VOCABULARY, token_bins=token_bins, alpha=alpha).fit(codes[search_idx], class_indices[search_idx])
+    return float(np.mean(model.predict_codes(codes[holdout_idx]) == class_indices[holdout_idx]))
+
+
+def search_hyperparameters(final_data, mode='random', iterations=SEARCH_ITERATIONS, grid=SEARCH_GRID, alphas=SEARCH_ALPHAS,
+                           k=CV_FOLDS, seed=SEARCH_SEED, workers=None, token_bins=TOKEN_BINS, top=5,
+                           max_candidates=SEARCH_MAX_CANDIDATES, holdout=SEARCH_HOLDOUT) -> dict:
+    start = time.perf_counter()
+
+    features = {column: np.asarray(final_data[column], dtype=np.float64) for column, _, _ in token_bins}
+    class_indices = encode_classes(final_data['Class'])
+
+    # Cross validation only sees the search documents, the holdout ones rescore the winner
+    search_idx, holdout_idx = holdout_split(len(class_indices), holdout, seed)
+    search_classes = class_indices[search_idx]
+    folds = stratified_folds(search_classes, k, 1, CV_SEED)[0]
+
+    # The current configuration is always one of the candidates, so the search never reports a worse one
+    cuts, levels = [], []
+    for column, thresholds, _ in token_bins:
+        flags = sorted({inclusive for _, inclusive in thresholds})
+        cuts.append(feature_cuts(list(grid[column]) + [value for value, _ in thresholds], flags))
+        levels.append(cut_levels(features[column][search_idx], cuts[-1]))
+
+    if mode == 'grid':
+        per_feature = grid_cut_indices(cuts, token_bins)
+        n_candidates = math.prod(len(indices) for indices in per_feature) * len(alphas)
+        generated = grid_candidates(per_feature, alphas)
+    else:
+        n_candidates = iterations
+        generated = random_candidates(cuts, token_bins, alphas, iterations, seed)
+
+    if n_candidates > max_candidates:
+        raise ValueError(f"The {mode} search would score {n_candidates:,} candidates, more than max_candidates="
+                         f"{max_candidates:,}: coarsen the grid or raise the limit")
+
+    histograms = level_histograms(levels, search_classes, folds, [len(feature_cuts_) + 1 for feature_cuts_ in cuts], len(CLASSES))
+
+    # Token codes of every (bin_1, ..., bin_f) cell, in the row-major order of the reduced histograms
+    offsets = np.cumsum([0] + [len(tokens) for _, _, tokens in token_bins[:-1]])
+    cell_codes = np.array(list(itertools.product(*[range(len(tokens)) for _, _, tokens in token_bins]))) + offsets
+
+    context = {'histograms': histograms, 'cell_codes': cell_codes, 'n_documents': len(search_classes),
+               'vocabulary': TOKEN_VOCABULARY, 'classes': CLASSES}
+    prepared = time.perf_counter() - start
+
+    # Scored first, so that it wins ties; the generators skip it when they reach it again
+    current = (tuple(tuple(cuts[feature].index((float(value), inclusive)) for value, inclusive in thresholds)
+                     for feature, (_, thresholds, _) in enumerate(token_bins)), 1.0)
+    candidates = itertools.chain([current], (candidate for candidate in generated if candidate != current))
+
+    init_search(context)
+    baseline_cv = float(evaluate_candidate(current))
+    ranked, scored = score_candidates(candidates, context, workers or os.cpu_count(), top)
+
+    def result(candidate, cv_accuracy):
+        bins = candidate_token_bins(candidate, cuts, token_bins)
+        return {'token_bins': bins, 'alpha': candidate[1], 'cv_accuracy': cv_accuracy}
+
+    baseline, best = result(current, baseline_cv), result(*ranked[0])
+    for entry in (baseline, best):
+        entry['holdout_accuracy'] = holdout_accuracy(features, class_indices, search_idx, holdout_idx,
+                                                     entry['token_bins'], entry['alpha'])
+
+    return {
+        'mode': mode,
+        'candidates': scored,
+        'folds': k,
+        'documents': len(class_indices),
+        'holdout_documents': len(holdout_idx),
+        'prepare_s': prepared,
+        'elapsed_s': time.perf_counter() - start,
+        'baseline': baseline,
+        'best': best,
+        'top': [result(candidate, cv_accuracy) for candidate, cv_accuracy in ranked],
+    }
+
+
+# e.g. "PunctajComponentaExamene: 30, 60; ...; Ajustare_Delay/Bonus: -1, 1+" (+ marks an exclusive threshold)
+def format_token_bins(token_bins) -> str:
+    return '; '.join(f"{column}: " + ', '.join(f"{value:g}" + ('' if inclusive else '+') for value, inclusive in thresholds)
+                     for column, thresholds, _ in token_bins)
+
+
+# Searches token thresholds and alpha, then fits and saves a model with the best configuration
+def run_hyperparameter_search(final_data, model_path=None, **kwargs):
+    print("\n\n>>> Started hyperparameter search <<<\n")
+
+    report = search_hyperparameters(final_data, **kwargs)
+
+    search_documents = report['documents'] - report['holdout_documents']
+    print(f"\t{report['candidates']:,} candidates x {report['folds']} folds over {search_documents:,} documents "
+          f"in {report['elapsed_s']:.2f}s ({report['prepare_s']:.2f}s building the fold histograms)")
+    print(f"\tCurrent configuration: CV {report['baseline']['cv_accuracy'] * 100:.2f}%, "
+          f"holdout {report['baseline']['holdout_accuracy'] * 100:.2f}%")
+    for rank, result in enumerate(report['top'], start=1):
+        print(f"\t{rank}. {result['cv_accuracy'] * 100:.2f}%  alpha={result['alpha']:g}  {format_token_bins(result['token_bins'])}")
+
+    best = report['best']
+    print(f"\tBest CV score (selection-biased): {best['cv_accuracy'] * 100:.2f}%, "
+          f"holdout accuracy over {report['holdout_documents']:,} documents: {best['holdout_accuracy'] * 100:.2f}%")
+
+    model = NaiveBayes(TOKEN_VOCABULARY, token_bins=best['token_bins'], alpha=best['alpha'])
+    model.fit(tokenize(final_data, best['token_bins']), encode_classes(final_data['Class']))
+    model.metadata = {'search': {key: report[key] for key in ['mode', 'candidates', 'folds', 'documents', 'holdout_documents',
+                                                              'baseline', 'best']}}
+
+    if model_path:
+        from model_store import save_model
+        save_model(model, model_path)
+        print(f"Model with the best configuration saved to {model_path}")
+
+    return report, model
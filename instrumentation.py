@@ -0,0 +1,249 @@
+import json
+import time
+import functools
+from collections import OrderedDict
+
+# Stage / sub-step instrumentation: duration, row counts, tracemalloc peak and SQLite statement time.
+# Disabled by default; a disabled span is one shared no-op object, so wrapped code pays a function call.
+# sqlite3 and tracemalloc are imported on first use: NumPy-only commands (`predict`) import this module too
+_enabled = False
+_trace_memory = False
+_records = []
+_stack = []
+
+
+class _NullSpan:
+    rows = property(lambda self: None, lambda self, value: None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.sql_time = 0.0
+        self.sql_statements = 0
+
+    def __enter__(self):
+        self.parent = _stack[-1] if _stack else None
+
+        if _trace_memory:
+            import tracemalloc
+
+            # The tracemalloc peak is global: fold it into the parent before resetting it for this span
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.memory_peak = max(self.parent.memory_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = self.memory_peak = current
+
+        _stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        _stack.pop()
+
+        memory_peak = None
+        if _trace_memory:
+            import tracemalloc
+
+            self.memory_peak = max(self.memory_peak, tracemalloc.get_traced_memory()[1])
+            memory_peak = self.memory_peak - self.memory_start
+            if self.parent is not None:
+                self.parent.memory_peak = max(self.parent.memory_peak, self.memory_peak)
+
+        _records.append({
+            'name': self.name,
+            'parent': self.parent.name if self.parent is not None else None,
+            'duration_s': duration,
+            'rows': self.rows,
+            'memory_peak_bytes': memory_peak,
+            'sql_time_s': self.sql_time,
+            'sql_statements': self.sql_statements,
+        })
+        return False
+
+
+def span(name):
+    return Span(name) if _enabled else _NULL_SPAN
+
+
+# Wraps a stage function in a span; rows(result) gives the stage's row count
+def instrumented(name, rows=None):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+
+            with Span(name) as stage:
+                result = fn(*args, **kwargs)
+                if rows is not None and result is not None:
+                    stage.rows = rows(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def enable(trace_memory=True):
+    global _enabled, _trace_memory
+    _enabled = True
+    _trace_memory = trace_memory
+    if trace_memory:
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+def disable():
+    global _enabled, _trace_memory
+    if _trace_memory:
+        import tracemalloc
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+    _enabled = _trace_memory = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    _records.clear()
+
+
+def _add_sql_time(elapsed):
+    for open_span in _stack:
+        open_span.sql_time += elapsed
+        open_span.sql_statements += 1
+
+
+_instrumented_connection = None
+
+
+# Connection class timing its statements, built on first use. Statement time covers execute and the fetches,
+# where SQLite steps through the rows
+def instrumented_connection_class():
+    global _instrumented_connection
+    if _instrumented_connection is not None:
+        return _instrumented_connection
+
+    import sqlite3
+
+    class InstrumentedCursor(sqlite3.Cursor):
+        def _timed(self, method, *args):
+            start = time.perf_counter()
+            try:
+                return method(self, *args)
+            finally:
+                _add_sql_time(time.perf_counter() - start)
+
+        def execute(self, *args):
+            return self._timed(sqlite3.Cursor.execute, *args)
+
+        def executemany(self, *args):
+            return self._timed(sqlite3.Cursor.executemany, *args)
+
+        def executescript(self, *args):
+            return self._timed(sqlite3.Cursor.executescript, *args)
+
+        def fetchone(self):
+            return self._timed(sqlite3.Cursor.fetchone)
+
+        def fetchmany(self, *args):
+            return self._timed(sqlite3.Cursor.fetchmany, *args)
+
+        def fetchall(self):
+            return self._timed(sqlite3.Cursor.fetchall)
+
+    class InstrumentedConnection(sqlite3.Connection):
+        def cursor(self, factory=InstrumentedCursor):
+            return super().cursor(factory)
+
+        def execute(self, *args):
+            return self.cursor().execute(*args)
+
+        def executemany(self, *args):
+            return self.cursor().executemany(*args)
+
+        def executescript(self, *args):
+            return self.cursor().executescript(*args)
+
+    _instrumented_connection = InstrumentedConnection
+    return _instrumented_connection
+
+
+# sqlite3.connect factory: statement timing only on connections opened while instrumentation is enabled
+def connection_factory():
+    import sqlite3
+
+    return instrumented_connection_class() if _enabled else sqlite3.Connection
+
+
+# Per span name: calls, total duration / rows / SQL time, largest memory peak
+def summary() -> OrderedDict:
+    stages = OrderedDict()
+    for record in _records:
+        stage = stages.setdefault(record['name'], {'calls': 0, 'duration_s': 0.0, 'rows': 0, 'memory_peak_bytes': None,
+                                                   'sql_time_s': 0.0, 'sql_statements': 0})
+        stage['calls'] += 1
+        stage['duration_s'] += record['duration_s']
+        stage['rows'] += record['rows'] or 0
+        stage['sql_time_s'] += record['sql_time_s']
+        stage['sql_statements'] += record['sql_statements']
+        if record['memory_peak_bytes'] is not None:
+            stage['memory_peak_bytes'] = max(stage['memory_peak_bytes'] or 0, record['memory_peak_bytes'])
+
+    return stages
+
+
+def write_json(path):
+    with open(path, 'w') as f:
+        json.dump({'stages': summary(), 'spans': _records}, f, indent=2)
+
+
+PROMETHEUS_METRICS = [
+    ('calls', 'pipeline_stage_calls', 'Number of times the stage ran'),
+    ('duration_s', 'pipeline_stage_duration_seconds', 'Total wall time of the stage'),
+    ('rows', 'pipeline_stage_rows', 'Rows produced by the stage'),
+    ('memory_peak_bytes', 'pipeline_stage_memory_peak_bytes', 'Largest tracemalloc peak above the stage start'),
+    ('sql_time_s', 'pipeline_stage_sql_seconds', 'Time spent executing SQLite statements and fetching their rows'),
+    ('sql_statements', 'pipeline_stage_sql_statements', 'SQLite statements and fetches issued by the stage'),
+]
+
+
+# Prometheus text exposition format (e.g. for node_exporter's textfile collector)
+def write_prometheus(path):
+    stages = summary()
+
+    lines = []
+    for key, metric, description in PROMETHEUS_METRICS:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} gauge")
+        for name, stage in stages.items():
+            if stage[key] is not None:
+                lines.append(f'{metric}{{stage="{name}"}} {stage[key]}')
+
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def print_summary():
+    print(f"\n{'stage':<36} {'calls':>6} {'time':>9} {'rows':>12} {'peak':>10} {'sql':>9}")
+    for name, stage in summary().items():
+        peak = f"{stage['memory_peak_bytes'] / (1024 * 1024):8.1f}MB" if stage['memory_peak_bytes'] is not None else f"{'-':>10}"
+        print(f"{name:<36} {stage['calls']:>6} {stage['duration_s']:8.3f}s {stage['rows']:>12,} {peak} {stage['sql_time_s']:8.3f}s")
@@ -1,23 +1,369 @@
-from dbconfig import run_db_setup
-from dataconfig import run_db_seed
-from classification import run_db_classification
-from tokenization import run_fd_tokenization
-from naive_bayes import run_naive_bayes
+import sys
+import time
+import argparse
 
-if __name__ == "__main__":
-    # Local database table-only configuration
-    run_db_setup()
+# Heavy libraries (pandas, the multiprocessing stages) are imported by the subcommands that need them,
+# `predict` only loads NumPy (and sqlite3 to read a student's materialized metrics)
+_started = time.perf_counter()
+_imported = None
+
+COMMANDS = ['run', 'setup', 'seed', 'classify', 'train', 'predict', 'whatif', 'bench']
+
+
+# Marks the end of a subcommand's imports, for --timings
+def imports_done():
+    global _imported
+    _imported = time.perf_counter()
+
+
+# Every random stage draws from its own seed, so skipping a cached stage does not shift the next one's draws
+def seed_stage(seed, stage):
+    import random
+
+    if seed is not None:
+        random.seed(f"{seed}/{stage}")
+
+
+def save_model_bytes(arrays):
+    from model_store import MODEL_PATH
+
+    arrays['model'].tofile(MODEL_PATH)
+    print(f"Model restored to {MODEL_PATH}")
+    return float(arrays['accuracy'])
+
+
+# Full pipeline (setup, seeding, classification, tokenization, training) with cached stages
+def cmd_run(args):
+    import numpy as np
+    import instrumentation
+    import dbconfig, dataconfig, classification, tokenization, naive_bayes, model_store, cross_validation, hyperparameter_search
+    from dbconfig import run_db_setup, shared_connection, close_connections, DB_NAME
+    from dataconfig import run_db_seed, STUDENT_COUNT
+    from classification import run_db_classification, ensure_attendance_stats, get_init_data
+    from tokenization import run_fd_tokenization, Dataset
+    from naive_bayes import run_naive_bayes
+    from model_store import MODEL_PATH
+    from hyperparameter_search import run_hyperparameter_search, SEARCH_ITERATIONS, SEARCH_MAX_CANDIDATES
+    from stage_cache import StageCache, CACHE_MAX_BYTES, code_version, database_fingerprint, frame_digest, array_digest, \
+        frame_to_arrays, arrays_to_frame
+    imports_done()
+
+    students = args.students or STUDENT_COUNT
+    search_iterations = args.search_iterations or SEARCH_ITERATIONS
+    max_candidates = args.max_candidates or SEARCH_MAX_CANDIDATES
+    cache_max_bytes = args.cache_max_mb * 1024 * 1024 if args.cache_max_mb is not None else CACHE_MAX_BYTES
+
+    # Enabled before the shared connection is opened, so its statements are timed
+    if args.metrics:
+        instrumentation.enable()
+
+    # Stage outputs are cached under a hash of their inputs; the random stages are only cached when seeded
+    cache = StageCache(max_bytes=cache_max_bytes, enabled=not args.no_cache)
+    seeded = args.seed is not None
+    conn = shared_connection(DB_NAME)
+
+    # Local database table-only configuration and seeding with random data (read documentation for data generation rules)
+    # Skipped when the database still holds what this seed produced
+    database_key = cache.key('database', code=code_version(dbconfig, dataconfig), students=students, seed=args.seed)
+    cached = cache.get('database', database_key) if seeded else None
+
+    if cached is not None and str(cached['fingerprint']) == database_fingerprint(conn):
+        print(">>> Database is up to date, skipping setup and seeding <<<")
+    else:
+        run_db_setup(reset=True)
+        seed_stage(args.seed, 'seed')
+        run_db_seed(students)
+        if seeded:
+            cache.put('database', database_key, {'fingerprint': np.array(database_fingerprint(conn))})
+
+    # Processes the data, calculates relevant scores and classifies the data in ['Promovat/Nepromovat'] (materialized into AttendanceStats)
+    def classify():
+        seed_stage(args.seed, 'classification')
+        return run_db_classification(materialize=True)
+
+    # The fingerprint leaves AttendanceStats out, so a hit after a reset or a refresh with other weights still
+    # rewrites the table from the cached frame, with the weights the seeded classification draws
+    def restore_classification(arrays):
+        final_data = arrays_to_frame(arrays)
+        seed_stage(args.seed, 'classification')
+        if ensure_attendance_stats(conn, final_data, get_init_data()):
+            print(">>> AttendanceStats restored from the cached classification <<<")
+        return final_data
 
-    # Database table seeding with random data (read documentation for data generation rules)
-    run_db_seed()
-    
-    # Processes the data, calculates relevant scores and classifies the data in ['Promovat/Nepromovat'] 
-    final_data = run_db_classification()
+    final_data = cache.run('classification',
+                           cache.key('classification', database=database_fingerprint(conn),
+                                     code=code_version(classification), seed=args.seed),
+                           classify, frame_to_arrays, restore_classification, cacheable=seeded)
 
     # Transforms scores into specific and comprehensive tokens
-    train_data = run_fd_tokenization(final_data) 
+    train_data = cache.run('tokenization',
+                           cache.key('tokenization', data=frame_digest(final_data), code=code_version(tokenization)),
+                           lambda: run_fd_tokenization(final_data),
+                           Dataset.to_arrays, Dataset.from_arrays)
+
+    # Naive Bayes model evaluation, the fitted model is saved for scoring
+    # With --search, token thresholds and Laplace alpha are searched first and the best configuration is saved;
+    # its accuracy is measured on the documents the search held out
+    def search():
+        report, _ = run_hyperparameter_search(final_data, model_path=MODEL_PATH, mode=args.search, iterations=search_iterations,
+                                              max_candidates=max_candidates)
+        return report['best']['holdout_accuracy']
+
+    if args.search:
+        accuracy = cache.run('search',
+                             cache.key('search', data=frame_digest(final_data), code=code_version(hyperparameter_search, naive_bayes, model_store),
+                                       mode=args.search, iterations=search_iterations),
+                             search,
+                             lambda result: {'accuracy': np.array(result), 'model': np.fromfile(MODEL_PATH, dtype=np.uint8)},
+                             save_model_bytes)
+    else:
+        accuracy = cache.run('training',
+                             cache.key('training', data=array_digest(*train_data.to_arrays().values()), code=code_version(naive_bayes, model_store, cross_validation),
+                                       cv_folds=args.cv_folds, cv_repeats=args.cv_repeats),
+                             lambda: run_naive_bayes(train_data, model_path=MODEL_PATH, cv_folds=args.cv_folds, cv_repeats=args.cv_repeats),
+                             lambda result: {'accuracy': np.array(result), 'model': np.fromfile(MODEL_PATH, dtype=np.uint8)},
+                             save_model_bytes)
+
+    print(f"Model's accuracy: {accuracy * 100:.2f}%")
+
+    # Every stage shared one database connection
+    close_connections()
+
+    if args.metrics:
+        instrumentation.print_summary()
+        instrumentation.write_json(f"{args.metrics}.json")
+        instrumentation.write_prometheus(f"{args.metrics}.prom")
+        print(f"Stage metrics written to {args.metrics}.json and {args.metrics}.prom")
+
+
+def cmd_setup(args):
+    from dbconfig import run_db_setup, close_connections
+    imports_done()
+
+    run_db_setup(reset=args.reset)
+    close_connections()
+
+
+def cmd_seed(args):
+    from dbconfig import close_connections
+    from dataconfig import run_db_seed, run_db_bulk_seed, STUDENT_COUNT
+    imports_done()
+
+    students = args.students or STUDENT_COUNT
+    if args.bulk:
+        run_db_bulk_seed(students, args.courses, seed=args.seed, workers=args.workers)
+    else:
+        seed_stage(args.seed, 'seed')
+        run_db_seed(students)
+    close_connections()
+
+
+def cmd_classify(args):
+    from dbconfig import close_connections
+    from classification import run_db_classification
+    imports_done()
+
+    seed_stage(args.seed, 'classification')
+    run_db_classification(args.chunk_students, args.memory_limit_mb, args.backend, materialize=True, workers=args.workers)
+    close_connections()
+
+
+# Trains on the metrics materialized by `classify` (AttendanceStats) instead of recomputing them, or on
+# as-of snapshots of the components at several cutoffs
+def cmd_train(args):
+    from dbconfig import shared_connection, close_connections, DB_NAME
+    from tokenization import read_attendance_features, run_fd_tokenization
+    from model_store import MODEL_PATH, AS_OF_MODEL_PATH
+    imports_done()
+
+    if args.as_of:
+        from as_of import run_as_of_snapshots
+
+        # Snapshots of one pair at several cutoffs are near duplicates: the evaluation holds out whole students,
+        # which the cross validation folds and the search do not
+        if args.cv_folds or args.search:
+            print("--as-of only supports the default holdout evaluation (no --cv-folds / --search)")
+            return 1
+
+        features = run_as_of_snapshots(args.as_of)
+        close_connections()
+        if features is None:
+            return 1
+    else:
+        features = read_attendance_features(shared_connection(DB_NAME))
+        close_connections()
+        if not len(features['Class']):
+            print("AttendanceStats is empty, run `python3 main.py classify` first")
+            return 1
+
+    model_path = args.model or (AS_OF_MODEL_PATH if args.as_of else MODEL_PATH)
+    if args.search:
+        from hyperparameter_search import run_hyperparameter_search, SEARCH_ITERATIONS, SEARCH_MAX_CANDIDATES
+
+        try:
+            report, _ = run_hyperparameter_search(features, model_path=model_path, mode=args.search,
+                                                  iterations=args.search_iterations or SEARCH_ITERATIONS,
+                                                  max_candidates=args.max_candidates or SEARCH_MAX_CANDIDATES)
+        except ValueError as e:
+            print(e)
+            return 1
+        accuracy = report['best']['holdout_accuracy']
+    else:
+        from naive_bayes import run_naive_bayes
+
+        dataset = run_fd_tokenization(features)
+        accuracy = run_naive_bayes(dataset, model_path=model_path, cv_folds=args.cv_folds, cv_repeats=args.cv_repeats,
+                                   groups=dataset.student_ids if args.as_of else None)
+
+    print(f"Model's accuracy: {accuracy * 100:.2f}%")
+
+
+# Scores a student's materialized metrics (or raw --features values) with the saved model
+def cmd_predict(args):
+    import numpy as np
+    from tokenization import read_attendance_features, decode_documents, tokenize
+    from model_store import load_model, MODEL_PATH
+    imports_done()
+
+    model = load_model(args.model or MODEL_PATH)
+
+    if args.features:
+        features = {column: np.array([value]) for (column, _, _), value in zip(model.token_bins, args.features)}
+        keys = [('-', '-')]
+    else:
+        from dbconfig import create_connection, DB_NAME
+
+        where, params = "WHERE student_id = ?", [args.student_id]
+        if args.course_id is not None:
+            where, params = where + " AND course_id = ?", params + [args.course_id]
+
+        conn = create_connection(args.db or DB_NAME, read_only=True)
+        features = read_attendance_features(conn, where, params)
+        conn.close()
+
+        keys = list(zip(features['student_id'].tolist(), features['course_id'].tolist()))
+        if not keys:
+            print(f"No AttendanceStats rows for student {args.student_id}, run `python3 main.py classify` first")
+            return 1
+
+    codes = tokenize(features, model.token_bins)
+    log_proba = model.predict_log_proba(codes)
+
+    for (student_id, course_id), tokens, row in zip(keys, decode_documents(codes, model.vocabulary), log_proba):
+        best = int(np.argmax(row))
+        print(f"student {student_id} course {course_id}: {model.classes[best]} ({np.exp(row[best]) * 100:.1f}%)  {tokens}")
+
+
+# Re-grades the materialized components for other calculation dates / weights without recomputing them
+def cmd_whatif(args):
+    from dbconfig import DB_NAME
+    from what_if import run_what_if
+    imports_done()
+
+    if run_what_if(args.dates, args.weights, args.db or DB_NAME) is None:
+        return 1
+
+
+def cmd_bench(args):
+    import benchmark
+    imports_done()
+
+    return benchmark.main(args.bench_args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Seeds the database, classifies students and trains the Naive Bayes model")
+    parser.add_argument('--timings', action='store_true', help="reports the import and run time of the command")
+    commands = parser.add_subparsers(dest='command')
+
+    run = commands.add_parser('run', help="full pipeline, the default command")
+    run.add_argument('--students', type=int, default=None)
+    run.add_argument('--seed', type=int, default=None, help="makes seeding and classification reproducible (and cacheable)")
+    run.add_argument('--no-cache', action='store_true', help="reruns every stage")
+    run.add_argument('--cache-max-mb', type=int, default=None)
+    run.add_argument('--cv-folds', type=int, default=None, help="evaluates with stratified k-fold cross validation")
+    run.add_argument('--cv-repeats', type=int, default=1)
+    run.add_argument('--search', choices=['random', 'grid'], default=None,
+                     help="searches token thresholds and Laplace alpha, the saved model uses the best configuration")
+    run.add_argument('--search-iterations', type=int, default=None, help="candidates of the random search")
+    run.add_argument('--max-candidates', type=int, default=None, help="fails a search that would score more candidates")
+    run.add_argument('--metrics', metavar='PREFIX', default=None,
+                     help="instruments the stages, writes PREFIX.json and PREFIX.prom (Prometheus text format)")
+    run.set_defaults(handler=cmd_run)
+
+    setup = commands.add_parser('setup', help="applies the schema migrations")
+    setup.add_argument('--reset', action='store_true', help="drops every table first")
+    setup.set_defaults(handler=cmd_setup)
+
+    seed = commands.add_parser('seed', help="seeds the database with random data")
+    seed.add_argument('--students', type=int, default=None)
+    seed.add_argument('--seed', type=int, default=None)
+    seed.add_argument('--bulk', action='store_true', help="recreates the database with the bulk seeder")
+    seed.add_argument('--courses', type=int, default=None, help="bulk seeder only")
+    seed.add_argument('--workers', type=int, default=1, help="bulk seeder only")
+    seed.set_defaults(handler=cmd_seed)
+
+    classify = commands.add_parser('classify', help="computes the metrics and materializes them into AttendanceStats")
+    classify.add_argument('--backend', choices=['pandas', 'sql'], default='pandas')
+    classify.add_argument('--chunk-students', type=int, default=None)
+    classify.add_argument('--memory-limit-mb', type=int, default=None)
+    classify.add_argument('--workers', type=int, default=None, help="classifies student ranges in a process pool")
+    classify.add_argument('--seed', type=int, default=None, help="seeds the calculation date")
+    classify.set_defaults(handler=cmd_classify)
+
+    train = commands.add_parser('train', help="trains and saves the model from AttendanceStats")
+    train.add_argument('--model', default=None)
+    train.add_argument('--cv-folds', type=int, default=None)
+    train.add_argument('--cv-repeats', type=int, default=1)
+    train.add_argument('--search', choices=['random', 'grid'], default=None)
+    train.add_argument('--search-iterations', type=int, default=None)
+    train.add_argument('--max-candidates', type=int, default=None)
+    train.add_argument('--as-of', nargs='+', metavar='DD.MM.YYYY', default=None,
+                       help="trains on point-in-time snapshots at these cutoffs, labelled with the final classes "
+                            "(saved to data/model_as_of.nbm unless --model is given)")
+    train.set_defaults(handler=cmd_train)
+
+    predict = commands.add_parser('predict', help="scores materialized metrics with the saved model (NumPy and sqlite3 only)")
+    target = predict.add_mutually_exclusive_group(required=True)
+    target.add_argument('--student-id', type=int)
+    target.add_argument('--features', type=float, nargs=3, metavar=('TODO', 'PRESENCES', 'ADJUSTMENT'))
+    predict.add_argument('--course-id', type=int, default=None)
+    predict.add_argument('--model', default=None)
+    predict.add_argument('--db', default=None)
+    predict.set_defaults(handler=cmd_predict)
+
+    whatif = commands.add_parser('whatif', help="re-grades AttendanceStats for other calculation dates or weights")
+    whatif.add_argument('--dates', nargs='+', metavar='DD.MM.YYYY', default=None, help="calculation dates (default: every date of the interval)")
+    whatif.add_argument('--weights', type=float, nargs=2, action='append', metavar=('PRESENCES', 'TODOS'), default=None,
+                        help="explicit weight pair, repeatable")
+    whatif.add_argument('--db', default=None)
+    whatif.set_defaults(handler=cmd_whatif)
+
+    # Its own arguments are left to benchmark.main
+    bench = commands.add_parser('bench', help="scaling benchmark, the arguments are passed to benchmark.py", add_help=False)
+    bench.set_defaults(handler=cmd_bench)
+
+    return parser
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+
+    # Without a subcommand, `python3 main.py [options]` runs the full pipeline as before
+    position = next((idx for idx, arg in enumerate(argv) if arg != '--timings'), len(argv))
+    if position == len(argv) or argv[position] not in COMMANDS + ['-h', '--help']:
+        argv.insert(position, 'run')
+
+    parser = build_parser()
+    args, args.bench_args = parser.parse_known_args(argv)
+    if args.bench_args and args.command != 'bench':
+        parser.error(f"unrecognized arguments: {' '.join(args.bench_args)}")
+    status = args.handler(args)
 
-    # Naive Bayes model evaluation
-    accuracy = run_naive_bayes(train_data)
+    if args.timings:
+        finished = time.perf_counter()
+        print(f"[timings] {args.command}: imports {(_imported - _started) * 1000:.1f} ms, "
+              f"command {(finished - _imported) * 1000:.1f} ms, total {(finished - _started) * 1000:.1f} ms "
+              f"(interpreter startup excluded)")
 
-    print(f"Model's accuracy: {accuracy * 100:.2f}%")
\ No newline at end of file
+    sys.exit(status or 0)
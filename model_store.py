@@ -0,0 +1,81 @@
+import json
+import mmap
+import struct
+import numpy as np
+from naive_bayes import NaiveBayes
+
+MODEL_PATH = 'data/model.nbm'
+# Models trained on as-of snapshots (`train --as-of`), kept apart from the one the scoring service loads
+AS_OF_MODEL_PATH = 'data/model_as_of.nbm'
+
+# File layout: MAGIC | version, header length (uint32) | JSON header | 64-byte aligned raw arrays
+MODEL_MAGIC = b'NBMODEL\0'
+MODEL_VERSION = 1
+MODEL_ARRAYS = ['class_count', 'token_count', 'class_log_prior', 'feature_log_prob']
+ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_model(model: NaiveBayes, path=MODEL_PATH):
+    arrays = {name: np.ascontiguousarray(getattr(model, name)) for name in MODEL_ARRAYS}
+
+    header = {
+        'vocabulary': model.vocabulary,
+        'classes': model.classes,
+        'token_bins': model.token_bins,
+        'alpha': model.alpha,
+        'metadata': model.metadata,
+        'arrays': {},
+    }
+
+    # Offsets depend on the header size, so they are laid out relative to the data section
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MODEL_MAGIC, MODEL_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+
+        for name, array in arrays.items():
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+
+
+# Memory-maps a saved model; arrays stay read-only views over the file unless mmap_arrays=False
+# (partial_fit / forget copy the counts on their first update)
+def load_model(path=MODEL_PATH, mmap_arrays=True) -> NaiveBayes:
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, header_length = _PREAMBLE.unpack_from(buffer, 0)
+    if magic != MODEL_MAGIC:
+        raise ValueError(f"{path} is not a Naive Bayes model file")
+    if version != MODEL_VERSION:
+        raise ValueError(f"Unsupported model file version {version} (expected {MODEL_VERSION})")
+
+    header = json.loads(buffer[_PREAMBLE.size:_PREAMBLE.size + header_length])
+    data_start = _align(_PREAMBLE.size + header_length)
+
+    token_bins = [(column, [tuple(threshold) for threshold in thresholds], tokens)
+                  for column, thresholds, tokens in header['token_bins']]
+    # Files written before alpha / metadata were stored used add-one smoothing
+    model = NaiveBayes(header['vocabulary'], header['classes'], token_bins=token_bins, alpha=header.get('alpha', 1.0))
+    model.metadata = header.get('metadata', {})
+
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + spec['offset']).reshape(spec['shape'])
+        setattr(model, name, array if mmap_arrays else array.copy())
+
+    return model
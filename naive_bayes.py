@@ -1,96 +1,179 @@
-# Probabilitati a Priori P(C)
-def aps_pbs(data):
-    data_count = len(data)
-    passed = sum(1 for _, clasa in data if clasa == 'Promovat')
+import math
+import numpy as np
+from tokenization import TOKEN_BINS, TOKEN_VOCABULARY, CLASSES, tokenize
+from instrumentation import instrumented, span
 
-    p_passed = passed / data_count
-    p_failed = 1 - p_passed
 
-    return {'Promovat': p_passed, 'Nepromovat': p_failed}
+# Documents -> token-code matrix (unknown tokens are coded as -1)
+def encode_documents(documents, vocabulary=TOKEN_VOCABULARY) -> np.ndarray:
+    token_ids = {token: idx for idx, token in enumerate(vocabulary)}
+    return np.array([[token_ids.get(token, -1) for token in document] for document in documents], dtype=np.int64)
 
 
-# P(wi|C) - Laplace Smoothing (flatten 0 probabilities)
-# P(wi|C) = (Count(wi, C) + 1) / (Total cuvinte în C + |V|)
-def model_learn(train_data):
-    classes = {'Promovat': [], 'Nepromovat': []}
-    token_set = set()
+def encode_classes(labels, classes=CLASSES) -> np.ndarray:
+    class_ids = {cls: idx for idx, cls in enumerate(classes)}
+    return np.array([class_ids[cls] for cls in labels], dtype=np.int64)
 
-    for stats_id, cls in train_data:
-        classes[cls].extend(stats_id)
-        token_set.update(stats_id)
 
-    token_set_size = len(token_set)
-    conditioned_probabilities = {}
+# Multinomial Naive Bayes over token-code matrices
+# Counts live in (class x token) arrays, log-probabilities are precomputed once per fit
+class NaiveBayes:
+    def __init__(self, vocabulary, classes=CLASSES, token_bins=TOKEN_BINS, alpha=1.0):
+        self.vocabulary = list(vocabulary)
+        self.classes = list(classes)
+        self.token_bins = token_bins
+        self.alpha = alpha
 
-    for cls, token_list in classes.items():
-        total_cls_token = len(token_list)
-        token_freq = {}
-        
-        for token in token_list:
-            token_freq[token] = token_freq.get(token, 0) + 1
+        # Saved with the model, e.g. the hyperparameter search that picked token_bins / alpha
+        self.metadata = {}
 
-        conditioned_probabilities[cls] = {}
-        for token in token_set:
-            token_wi_C = token_freq.get(token, 0)
-        # P(wi|C) - Laplace Smoothing (flatten 0 probabilities)
-            prob_wi_C = (token_wi_C + 1) / (total_cls_token + token_set_size)
-            conditioned_probabilities[cls][token] = prob_wi_C
+        self.class_count = np.zeros(len(self.classes), dtype=np.int64)
+        self.token_count = np.zeros((len(self.classes), len(self.vocabulary)), dtype=np.int64)
 
-    return conditioned_probabilities, token_set
+        self.class_log_prior = None
+        self.feature_log_prob = None
 
+    def fit(self, codes: np.ndarray, labels: np.ndarray):
+        self._writable_counts()
+        self.class_count[:] = 0
+        self.token_count[:] = 0
 
-import math
+        self._accumulate(codes, labels)
+        self._update_log_prob()
+
+        return self
+
+    # Online training: adds a batch of new documents to the counts, O(batch)
+    def partial_fit(self, codes: np.ndarray, labels: np.ndarray):
+        self._accumulate(codes, labels)
+        self._update_log_prob()
+
+        return self
+
+    # Retracts previously learned documents (e.g. before re-adding a corrected grade)
+    def forget(self, codes: np.ndarray, labels: np.ndarray):
+        self._accumulate(codes, labels, sign=-1)
+
+        if (self.class_count < 0).any() or (self.token_count < 0).any():
+            self._accumulate(codes, labels)
+            raise ValueError("Cannot forget documents that were never learned")
+
+        self._update_log_prob()
+
+        return self
+
+    # Counts of a model memory-mapped by model_store.load_model are read-only views of the file: the first
+    # update replaces them with private copies and leaves the file untouched
+    def _writable_counts(self):
+        if not self.class_count.flags.writeable:
+            self.class_count = self.class_count.copy()
+        if not self.token_count.flags.writeable:
+            self.token_count = self.token_count.copy()
+
+    def _accumulate(self, codes: np.ndarray, labels: np.ndarray, sign: int = 1):
+        self._writable_counts()
+        codes = np.asarray(codes)
+        labels = np.asarray(labels).astype(np.int64, copy=False)
+        n_classes, n_tokens = self.token_count.shape
+
+        self.class_count += sign * np.bincount(labels, minlength=n_classes)
+
+        # Flat (class, token) index for every token occurrence
+        known = codes >= 0
+        flat = (np.broadcast_to(labels[:, None], codes.shape) * n_tokens + codes)[known]
+        self.token_count += sign * np.bincount(flat, minlength=n_classes * n_tokens).reshape(n_classes, n_tokens)
+
+    # P(C) = Count(C) / N
+    # P(wi|C) - Laplace Smoothing (flatten 0 probabilities)
+    # P(wi|C) = (Count(wi, C) + alpha) / (Total cuvinte în C + alpha * |V|), alpha = 1 is add-one smoothing
+    def _update_log_prob(self):
+        # |V| counts only the tokens seen during training
+        vocabulary_size = np.count_nonzero(self.token_count.sum(axis=0))
+        total_cls_token = self.token_count.sum(axis=1, keepdims=True)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.class_log_prior = np.log(self.class_count / self.class_count.sum())
+
+            # The extra last column scores unknown tokens (code -1) as unseen ones
+            smoothed = np.concatenate([self.token_count, np.zeros((len(self.classes), 1), dtype=np.int64)], axis=1)
+            self.feature_log_prob = np.log((smoothed + self.alpha) / (total_cls_token + self.alpha * vocabulary_size))
+
+    # log P(C) + sum(log P(wi|C)) for every document, shape (documents x classes)
+    def joint_log_likelihood(self, codes: np.ndarray) -> np.ndarray:
+        codes = np.asarray(codes)
+        return self.class_log_prior + self.feature_log_prob[:, codes].sum(axis=2).T
+
+    def predict_log_proba(self, codes: np.ndarray) -> np.ndarray:
+        jll = self.joint_log_likelihood(codes)
+        log_norm = np.logaddexp.reduce(jll, axis=1, keepdims=True)
+        return jll - log_norm
+
+    def predict_codes(self, codes: np.ndarray) -> np.ndarray:
+        return np.argmax(self.joint_log_likelihood(codes), axis=1)
+
+    def predict(self, codes: np.ndarray) -> np.ndarray:
+        return np.asarray(self.classes)[self.predict_codes(codes)]
+
+    # Tokenizes raw metrics with the thresholds the model was trained on, then predicts
+    def predict_metrics(self, final_data) -> np.ndarray:
+        return self.predict(tokenize(final_data, self.token_bins))
+
+
+# (train, test) indices of a shuffled holdout, the same split as sklearn's
+# train_test_split(test_size=test_size, random_state=random_state) without importing sklearn
+def holdout_split(n_documents, test_size=0.2, random_state=42):
+    n_test = math.ceil(test_size * n_documents)
+    permutation = np.random.RandomState(random_state).permutation(n_documents)
+    return permutation[n_test:], permutation[:n_test]
+
+
+# holdout_split over the distinct groups (e.g. students): every row of a group lands on the same side
+def group_holdout_split(groups, test_size=0.2, random_state=42):
+    unique_groups, group_of_row = np.unique(np.asarray(groups), return_inverse=True)
+    _, test_groups = holdout_split(len(unique_groups), test_size, random_state)
+    test_rows = np.isin(group_of_row, test_groups)
+    return np.flatnonzero(~test_rows), np.flatnonzero(test_rows)
+
+
+# Evaluates model and saves it for scoring
+# cv_folds switches the single 80/20 holdout to (repeated) stratified k-fold cross validation: the returned
+# accuracy is the mean over the folds and the saved model is fitted on every document
+# groups (one value per document) holds out whole groups, for documents that are not independent
+@instrumented('training')
+def run_naive_bayes(dataset, model_path=None, cv_folds=None, cv_repeats=1, cv_workers=None, groups=None):
+    if cv_folds:
+        from cross_validation import run_cross_validation
+
+        report = run_cross_validation(dataset, cv_folds, cv_repeats, workers=cv_workers)
+
+        with span('training.fit') as step:
+            model = NaiveBayes(TOKEN_VOCABULARY, dataset.classes).fit(dataset.codes, dataset.labels)
+            step.rows = len(dataset)
+
+        if model_path:
+            from model_store import save_model
+            save_model(model, model_path)
+            print(f"Model saved to {model_path}")
+
+        return report['aggregate']['accuracy']['mean']
+
+    train_idx, test_idx = holdout_split(len(dataset)) if groups is None else group_holdout_split(groups)
+    train, test = dataset.take(train_idx), dataset.take(test_idx)
+
+    with span('training.fit') as step:
+        model = NaiveBayes(TOKEN_VOCABULARY, dataset.classes).fit(train.codes, train.labels)
+        step.rows = len(train)
+
+    with span('training.predict') as step:
+        guess_classes = model.predict_codes(test.codes)
+        step.rows = len(test)
+    correct_predictions = np.count_nonzero(guess_classes == test.labels)
+
+    accuracy = correct_predictions / len(test)
+
+    if model_path:
+        from model_store import save_model
+        save_model(model, model_path)
+        print(f"Model saved to {model_path}")
 
-def classify_tokens(document, aps_cls, conditioned_probabilities, token_set):
-    scores = {}
-    nm_smoothing = {}
-    token_set_count = len(token_set)
-
-    for cls, prob_dict in conditioned_probabilities.items():
-        if prob_dict:
-            p_ex = next(iter(prob_dict.values()))
-            nm_smoothing[cls] = 1.0 / p_ex
-        else:
-            nm_smoothing[cls] = token_set_count + 1
-
-    for cls, ap_cls in aps_cls.items():
-        log_score = math.log(ap_cls)
-        
-        for token in document:
-            p_wi_C = 0
-
-            if token in conditioned_probabilities[cls]:
-                p_wi_C = conditioned_probabilities[cls][token]
-            else:
-                p_wi_C = 1.0 / (nm_smoothing[cls])
-            
-            log_score += math.log(p_wi_C)
-            
-        scores[cls] = log_score
-        
-    guess_class = max(scores, key=scores.get)
-
-    return guess_class, scores
-
-# Evaluates model
-from sklearn.model_selection import train_test_split
-def run_naive_bayes(initial_df):
-    train_data, test_data = train_test_split(initial_df, test_size=0.2, random_state=42)
-
-    aps = aps_pbs(train_data)
-    conditioned_probabilities, token_set = model_learn(train_data)
-
-    correct_predictions = 0
-
-    for document, real_class in test_data:
-        guess_class, _ = classify_tokens(   document, \
-                                            aps, \
-                                            conditioned_probabilities,\
-                                            token_set)
-        
-        if guess_class == real_class:
-            correct_predictions += 1
-
-    accuracy = correct_predictions / len(test_data)
-
-    return accuracy
\ No newline at end of file
+    return accuracy
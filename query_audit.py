@@ -0,0 +1,79 @@
+import re
+import sys
+import argparse
+from dbconfig import create_connection, DB_NAME
+from classification import classification_query, metrics_query, DIRTY_STUDENTS_QUERY, DIRTY_STUDENTS_WHERE, STUDENT_STATS_DELETE
+from scoring_service import STAMP_QUERY
+
+# Tables that grow with the number of students; a full scan of one of them fails the audit
+LARGE_TABLES = {'Student', 'hasDone', 'hasPresences', 'AttendanceStats', 'StudentUpdates'}
+
+# Aliases used by the pipeline's queries
+TABLE_ALIASES = {'S': 'Student', 'C': 'Course', 'HW': 'hasWeights', 'HT': 'hasTodo', 'HD': 'hasDone', 'HP': 'hasPresences'}
+
+# (name, sql, params, large tables a full pass is expected to scan)
+AUDITED_QUERIES = [
+    ('classification (full)', classification_query(), (), {'Student'}),
+    ('classification (student)', classification_query("WHERE S.id = ?"), (1,), set()),
+    ('classification (student range)', classification_query("WHERE S.id BETWEEN ? AND ?"), (1, 1000), set()),
+    ('classification (dirty students)', classification_query(DIRTY_STUDENTS_WHERE), (0.0,), set()),
+    ('metrics sql (full)', metrics_query(), (), {'Student'}),
+    ('metrics sql (student range)', metrics_query("WHERE S.id BETWEEN ? AND ?"), (1, 1000), set()),
+    ('metrics sql (dirty students)', metrics_query(DIRTY_STUDENTS_WHERE), (0.0,), set()),
+    ('refresh dirty students', DIRTY_STUDENTS_QUERY, (0.0,), set()),
+    ('refresh delete (one student)', STUDENT_STATS_DELETE, (0,), set()),
+    ('scoring stamps', STAMP_QUERY, (1,), set()),
+]
+
+_SCAN = re.compile(r'^SCAN (\w+)')
+_AUTOMATIC = re.compile(r'^(?:SEARCH|SCAN) (\w+) USING AUTOMATIC')
+
+
+def query_plan(conn, sql, params=()):
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+
+# Returns the plan lines that scan (or build an automatic index over) a large table not in `allowed`
+def plan_violations(plan, allowed=()):
+    violations = []
+    for detail in plan:
+        match = _AUTOMATIC.match(detail) or _SCAN.match(detail)
+        if match is None:
+            continue
+
+        table = TABLE_ALIASES.get(match.group(1), match.group(1))
+        if table in LARGE_TABLES and table not in allowed:
+            violations.append(detail)
+
+    return violations
+
+
+def audit_queries(conn, verbose=False) -> bool:
+    passed = True
+
+    for name, sql, params, allowed in AUDITED_QUERIES:
+        plan = query_plan(conn, sql, params)
+        violations = plan_violations(plan, allowed)
+        passed = passed and not violations
+
+        print(f"{'FAIL' if violations else 'ok  '} {name}")
+        for detail in (plan if verbose else violations):
+            print(f"\t{detail}")
+
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN QUERY PLAN audit of the pipeline's queries")
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--verbose', action='store_true', help="prints every plan line")
+    args = parser.parse_args()
+
+    conn = create_connection(args.db, read_only=True)
+    if conn is None:
+        sys.exit(2)
+
+    passed = audit_queries(conn, args.verbose)
+    conn.close()
+
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,337 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+from dbconfig import ConnectionManager, DB_NAME
+from classification import read_classification_frame, compute_metrics, get_init_data, REFRESH_NAME
+from tokenization import TOKEN_BINS, decode_documents, tokenize
+from model_store import load_model, MODEL_PATH
+
+FEATURE_COLUMNS = [column for column, _, _ in TOKEN_BINS]
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+CACHE_SIZE = 4096
+
+# Threads computing cache misses, each one reading through its own read-only connection
+SERVICE_WORKERS = 4
+
+# Latest change affecting a student: their own rows or any course definition
+STAMP_QUERY = """
+    SELECT MAX(updated_at) FROM (
+        SELECT updated_at FROM StudentUpdates WHERE student_id = ?
+        UNION ALL
+        SELECT MAX(updated_at) FROM CourseUpdates
+    );
+"""
+
+
+# Per-student features, keyed by course_id, computed at `computed_at` (julianday, database clock)
+class StudentFeatures:
+    def __init__(self, features: pd.DataFrame, computed_at: float, data_version: int, schema_version: int, token_bins=TOKEN_BINS):
+        self.courses = {int(course_id): idx for idx, course_id in enumerate(features['course_id'])}
+        self.values = features[FEATURE_COLUMNS].to_numpy()
+        self.codes = tokenize(features, token_bins)
+        self.computed_at = computed_at
+        self.data_version = data_version
+        self.schema_version = schema_version
+
+
+# Weights AttendanceStats was materialized with; without a refresh, a calculation date is drawn once
+def service_weights(conn):
+    row = conn.execute("SELECT w_presence, w_todos FROM RefreshState WHERE name = ?;", (REFRESH_NAME,)).fetchone()
+    return tuple(row) if row is not None else get_init_data()
+
+
+# LRU cache of StudentFeatures, invalidated by StudentUpdates / CourseUpdates timestamps
+# token_bins are the thresholds the served model was trained with, weights the (presences, todos) weights
+# Every query goes through the calling thread's read-only connection (connections.reader()): lookup / store
+# run on the event loop thread, compute on the executor threads and never touches the entries
+class FeatureCache:
+    def __init__(self, connections, weights, capacity=CACHE_SIZE, token_bins=TOKEN_BINS):
+        self.connections = connections
+        self.weights = weights
+        self.capacity = capacity
+        self.token_bins = token_bins
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def conn(self):
+        return self.connections.reader()
+
+    # PRAGMA data_version is per connection: entries only compare values read on the lookup thread's connection
+    def _data_version(self):
+        return self.conn.execute("PRAGMA data_version;").fetchone()[0]
+
+    def _schema_version(self):
+        return self.conn.execute("PRAGMA schema_version;").fetchone()[0]
+
+    def _is_fresh(self, student_id, entry: StudentFeatures, data_version):
+        # Nothing was committed by another connection since the entry was last validated
+        if entry.data_version == data_version:
+            return True
+
+        # Rebuilt database (setup / bulk seeding), which carries no update stamps
+        if entry.schema_version != self._schema_version():
+            return False
+
+        updated_at = self.conn.execute(STAMP_QUERY, (student_id,)).fetchone()[0]
+
+        if updated_at is not None and updated_at >= entry.computed_at:
+            return False
+
+        entry.data_version = data_version
+        return True
+
+    # Point query over one student (the delay/bonus rate sequence spans all of their courses)
+    # data_version is the lookup thread's value, read before the miss was dispatched
+    def compute(self, student_id, data_version):
+        conn = self.conn
+        computed_at = conn.execute("SELECT julianday('now');").fetchone()[0]
+        data = read_classification_frame(conn, "WHERE S.id = ?", (student_id,))
+        if data.empty:
+            return None
+
+        return StudentFeatures(compute_metrics(data, self.weights), computed_at, data_version, self._schema_version(),
+                               self.token_bins)
+
+    # (fresh entry or None, data_version to compute a miss with)
+    def lookup(self, student_id):
+        data_version = self._data_version()
+
+        entry = self.entries.get(student_id)
+        if entry is not None and self._is_fresh(student_id, entry, data_version):
+            self.entries.move_to_end(student_id)
+            self.hits += 1
+            return entry, data_version
+
+        self.misses += 1
+        return None, data_version
+
+    def store(self, student_id, entry):
+        if entry is None:
+            self.entries.pop(student_id, None)
+            return None
+
+        self.entries[student_id] = entry
+        self.entries.move_to_end(student_id)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+        return entry
+
+    def get(self, student_id):
+        entry, data_version = self.lookup(student_id)
+        if entry is not None:
+            return entry
+
+        return self.store(student_id, self.compute(student_id, data_version))
+
+
+class ScoringService:
+    def __init__(self, db_file=DB_NAME, model_path=MODEL_PATH, cache_size=CACHE_SIZE, workers=SERVICE_WORKERS, weights=None):
+        # Read-only (mode=ro) connections: scoring never writes, and WAL lets it read while the pipeline commits
+        self.connections = ConnectionManager(db_file)
+        self.model = load_model(model_path)
+        self.cache = FeatureCache(self.connections, weights or service_weights(self.connections.reader()),
+                                  cache_size, self.model.token_bins)
+
+        # Cache misses (SQL fetch + pandas metrics) run off the event loop; concurrent misses for the same
+        # student share one computation
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = {}
+
+    async def features(self, student_id):
+        entry, data_version = self.cache.lookup(student_id)
+        if entry is not None:
+            return entry
+
+        pending = self.pending.get(student_id)
+        if pending is not None:
+            return await pending
+
+        pending = asyncio.get_running_loop().run_in_executor(self.executor, self.cache.compute, student_id, data_version)
+        self.pending[student_id] = pending
+        try:
+            return self.cache.store(student_id, await pending)
+        finally:
+            del self.pending[student_id]
+
+    async def predict(self, student_id, course_id):
+        entry = await self.features(student_id)
+        if entry is None or course_id not in entry.courses:
+            return None
+
+        idx = entry.courses[course_id]
+        codes = entry.codes[idx:idx + 1]
+        log_proba = self.model.predict_log_proba(codes)[0]
+
+        return {
+            'student_id': student_id,
+            'course_id': course_id,
+            'features': dict(zip(FEATURE_COLUMNS, entry.values[idx].tolist())),
+            'tokens': decode_documents(codes)[0],
+            'prediction': self.model.classes[int(np.argmax(log_proba))],
+            'log_proba': dict(zip(self.model.classes, log_proba.tolist())),
+        }
+
+    async def route(self, target):
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if url.path == '/health':
+            return 200, {'status': 'ok', 'cache': {'size': len(self.cache.entries),
+                                                   'hits': self.cache.hits,
+                                                   'misses': self.cache.misses}}
+
+        if url.path == '/predict':
+            try:
+                student_id = int(query['student_id'][0])
+                course_id = int(query['course_id'][0])
+            except (KeyError, ValueError):
+                return 400, {'error': 'student_id and course_id must be integers'}
+
+            result = await self.predict(student_id, course_id)
+            if result is None:
+                return 404, {'error': f'No data for student {student_id}, course {course_id}'}
+            return 200, result
+
+        return 404, {'error': f'Unknown path {url.path}'}
+
+    # Minimal HTTP/1.1 handler with keep-alive
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3 or parts[0] != 'GET':
+                    status, body = 405, {'error': 'Only GET requests are supported'}
+                else:
+                    status, body = await self.route(parts[1])
+
+                payload = json.dumps(body).encode('utf-8')
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.connections.close()
+
+
+async def serve(host=SERVICE_HOST, port=SERVICE_PORT, **kwargs):
+    service = ScoringService(**kwargs)
+    server = await asyncio.start_server(service.handle, host, port)
+
+    print(f"Scoring service listening on http://{host}:{port}/predict?student_id=&course_id=")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+# Load generator: `concurrency` keep-alive clients sending random predict requests
+async def run_load(host=SERVICE_HOST, port=SERVICE_PORT, requests=2000, concurrency=16, students=200, courses=13):
+    latencies = []
+    errors = 0
+
+    async def client(n_requests):
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(host, port)
+
+        for _ in range(n_requests):
+            target = f"/predict?student_id={random.randint(1, students)}&course_id={random.randint(1, courses)}"
+            start = time.perf_counter()
+
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode('latin-1'))
+            await writer.drain()
+
+            status_line = await reader.readline()
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                if line.lower().startswith(b'content-length:'):
+                    content_length = int(line.split(b':')[1])
+            await reader.readexactly(content_length)
+
+            latencies.append(time.perf_counter() - start)
+            if b' 200 ' not in status_line:
+                errors += 1
+
+        writer.close()
+
+    per_client = [requests // concurrency + (1 if idx < requests % concurrency else 0) for idx in range(concurrency)]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(n) for n in per_client if n))
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    report = {
+        'requests': len(latencies),
+        'errors': errors,
+        'concurrency': concurrency,
+        'rps': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+    }
+
+    print(f"{report['requests']} requests ({errors} errors) in {elapsed:.2f}s: "
+          f"{report['rps']:.0f} req/s, p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms")
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Naive Bayes scoring service")
+    parser.add_argument('mode', choices=['serve', 'load'])
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--db', default=DB_NAME)
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE)
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS, help="threads computing cache misses")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--students', type=int, default=200)
+    parser.add_argument('--courses', type=int, default=13)
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        asyncio.run(serve(args.host, args.port, db_file=args.db, model_path=args.model, cache_size=args.cache_size,
+                          workers=args.workers))
+    else:
+        asyncio.run(run_load(args.host, args.port, args.requests, args.concurrency, args.students, args.courses))
@@ -0,0 +1,159 @@
+import os
+import io
+import json
+import hashlib
+import inspect
+import sqlite3
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = 'data/cache'
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Aggregates over the metric source tables; row keys weight the values so moving a value to another row shows up.
+# Later edits are also caught by the StudentUpdates / CourseUpdates stamps. Derived tables (AttendanceStats,
+# RefreshState) are left out: materializing metrics does not change the fingerprint of their inputs
+FINGERPRINT_QUERIES = {
+    'ExamType': "SELECT COUNT(*), TOTAL(id), TOTAL(id * length(name)) FROM ExamType;",
+    'Student': "SELECT COUNT(*), TOTAL(id), TOTAL(id * length(name)) FROM Student;",
+    'Course': "SELECT COUNT(*), TOTAL(id), TOTAL(id * length(name)) FROM Course;",
+    'hasWeights': "SELECT COUNT(*), TOTAL(course_id * exam_type_id), TOTAL(weight * (course_id + exam_type_id)), "
+                  "TOTAL(required_presences * (course_id + exam_type_id)) FROM hasWeights;",
+    'hasTodo': "SELECT COUNT(*), TOTAL(todo_id), TOTAL(todo_id * (course_id + exam_type_id)), TOTAL(todo_id * max_points), "
+               "TOTAL(todo_id * weight), TOTAL(todo_id * deadline) FROM hasTodo;",
+    'hasDone': "SELECT COUNT(*), TOTAL(student_id * todo_id), TOTAL(points * (student_id + todo_id)), "
+               "COUNT(handled), TOTAL((student_id + todo_id) * handled) FROM hasDone;",
+    'hasPresences': "SELECT COUNT(*), TOTAL(student_id * (course_id + exam_type_id)), "
+                    "TOTAL(presences * (student_id + course_id + exam_type_id)) FROM hasPresences;",
+    'StudentUpdates': "SELECT COUNT(*), MAX(updated_at) FROM StudentUpdates;",
+    'CourseUpdates': "SELECT COUNT(*), MAX(updated_at) FROM CourseUpdates;",
+}
+
+
+def _digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# Content fingerprint of the metric source tables, None if the schema is missing or outdated
+def database_fingerprint(conn):
+    try:
+        values = {'user_version': conn.execute("PRAGMA user_version;").fetchone()[0]}
+        for table, sql in FINGERPRINT_QUERIES.items():
+            values[table] = list(conn.execute(sql).fetchone())
+    except sqlite3.Error:
+        return None
+
+    return _digest(values)
+
+
+# Hash of the source files of the modules a stage runs
+def code_version(*modules) -> str:
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(inspect.getsourcefile(module), 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def array_digest(*arrays) -> str:
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode('utf-8'))
+        digest.update(array.tobytes() if array.dtype != object else json.dumps(array.tolist()).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def frame_digest(frame: pd.DataFrame) -> str:
+    return array_digest(np.array(frame.columns, dtype=str), pd.util.hash_pandas_object(frame, index=False).to_numpy())
+
+
+# DataFrame <-> npz arrays: one array per column, object columns stored as fixed-width strings
+def frame_to_arrays(frame: pd.DataFrame) -> dict:
+    arrays = {'columns': np.array(frame.columns, dtype=str)}
+    for idx, column in enumerate(frame.columns):
+        values = frame[column].to_numpy()
+        arrays[f"column_{idx}"] = values.astype(str) if values.dtype == object else values
+
+    return arrays
+
+
+def arrays_to_frame(arrays: dict) -> pd.DataFrame:
+    columns = arrays['columns'].tolist()
+    return pd.DataFrame({column: arrays[f"column_{idx}"] for idx, column in enumerate(columns)})
+
+
+# On-disk cache of stage outputs, one npz file per (stage, key); least recently used entries are
+# evicted once the cache grows over max_bytes
+class StageCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, enabled=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    # Key of a stage run: hash of everything its output depends on
+    def key(self, stage, **inputs) -> str:
+        return _digest({'stage': stage, **inputs})
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, f"{stage}-{key[:32]}.npz")
+
+    def get(self, stage, key):
+        if not self.enabled:
+            return None
+
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+
+        os.utime(path)
+        print(f"\tCache hit for stage '{stage}' ({os.path.basename(path)})")
+        return arrays
+
+    def put(self, stage, key, arrays):
+        if not self.enabled:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(stage, key)
+
+        # Written next to the entry then renamed, so a reader never sees a partial file
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        with open(f"{path}.tmp", 'wb') as f:
+            f.write(buffer.getbuffer())
+        os.replace(f"{path}.tmp", path)
+
+        self.evict()
+
+    # Returns decode(cached arrays) on a hit, otherwise compute() (stored as encode(result) when cacheable)
+    def run(self, stage, key, compute, encode, decode, cacheable=True):
+        cached = self.get(stage, key) if cacheable else None
+        if cached is not None:
+            return decode(cached)
+
+        result = compute()
+        if cacheable:
+            self.put(stage, key, encode(result))
+        return result
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+            print(f"\tEvicted {os.path.basename(path)} from the stage cache")
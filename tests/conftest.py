@@ -0,0 +1,29 @@
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dbconfig import shared_connection, close_connections
+from dataconfig import run_db_bulk_seed
+
+TEST_STUDENTS = 60
+TEST_SEED = 7
+
+
+# Small bulk-seeded database shared by the whole session (the seeder is deterministic for a fixed seed)
+@pytest.fixture(scope='session')
+def seeded_db(tmp_path_factory):
+    db_file = str(tmp_path_factory.mktemp('db') / 'students.db')
+    run_db_bulk_seed(TEST_STUDENTS, seed=TEST_SEED, db_file=db_file)
+    close_connections(db_file)
+
+    yield db_file
+    close_connections(db_file)
+
+
+@pytest.fixture
+def conn(seeded_db):
+    yield shared_connection(seeded_db)
+    close_connections(seeded_db)
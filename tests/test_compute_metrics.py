@@ -0,0 +1,283 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from dbconfig import shared_connection, close_connections, setup_database
+from classification import compute_metrics, compute_metrics_sql, compute_metrics_parallel, read_classification_frame, \
+    classification_query, CLASSIFICATION_DTYPES, PASSING_GRADE
+
+WEIGHTS = (80, 20)
+METRIC_COLUMNS = ['student_id', 'course_id', 'PunctajComponentaExamene', 'ScorPrezenteExam', 'Ajustare_Delay/Bonus',
+                  'NotaAproximativa', 'Class']
+
+
+# Row-wise implementation compute_metrics replaced (generator per student, iterrows, apply), kept as the
+# reference. Only the inputs changed since: dates are epoch days and the weights are passed in
+def baseline_compute_metrics(data: pd.DataFrame, weights) -> pd.DataFrame:
+    w_presence, w_todos = weights
+    student_adjustments = {}
+
+    def adjust_todo(group: pd.DataFrame) -> pd.DataFrame:
+        def adjust_generator():
+            rates = [0.0005, 0.001, 0.002, 0.004, 0.008]
+            rate_index = 0
+
+            while True:
+                if rate_index < len(rates):
+                    yield rates[rate_index]
+                    rate_index += 1
+                else:
+                    yield 0
+
+        student_id = group.name[0]
+
+        if student_id not in student_adjustments:
+            student_adjustments[student_id] = {'gen': adjust_generator(), 'count': 0}
+
+        group = group.sort_values(by='deadline', ascending=True)
+
+        final_adjustment_percent = 0
+
+        for index, row in group.iterrows():
+            diff_days = row['diff_days']
+
+            if diff_days != 0 and pd.notna(row['handled']):
+                adjust_rate = next(student_adjustments[student_id]['gen'])
+                days_limit = min(abs(diff_days), 30)
+
+                final_adjust = adjust_rate * days_limit * 100
+
+                if diff_days > 0:
+                    final_adjustment_percent -= final_adjust
+                elif diff_days < 0:
+                    final_adjustment_percent += final_adjust
+
+        return pd.Series({
+            'Ajustare_Delay/Bonus': final_adjustment_percent,
+            'PunctajNormalizatTodo_E_Unic': group['PunctajNormalizatTodo_E'].iloc[0]
+        })
+
+    data['scor_total_todo'] = (data['points'] / data['max_points']) * data['todo_weight']
+
+    todo_scores = data.groupby(['student_id', 'course_id', 'exam_type_id']).agg(
+        scor_total_todo_E=('scor_total_todo', 'sum'),
+        suma_greutati_todo_E=('todo_weight', 'sum')
+    ).reset_index()
+
+    todo_scores['PunctajNormalizatTodo_E'] = (
+        todo_scores['scor_total_todo_E'] / todo_scores['suma_greutati_todo_E']
+    ) * 100
+
+    data = data.merge(todo_scores[['student_id', 'course_id', 'exam_type_id', 'PunctajNormalizatTodo_E', 'suma_greutati_todo_E']],
+                      on=['student_id', 'course_id', 'exam_type_id'],
+                      how='left')
+
+    data['diff_days'] = data.apply(lambda row: row['handled'] - row['deadline'] if pd.notna(row['handled']) else 0, axis=1)
+
+    adjustments = data.groupby(['student_id', 'course_id']).apply(adjust_todo, include_groups=False).reset_index()
+    final_scores = todo_scores.merge(adjustments[['student_id', 'course_id', 'Ajustare_Delay/Bonus']],
+                                     on=['student_id', 'course_id'],
+                                     how='left')
+
+    final_scores['PunctajAjustatTodo_E'] = final_scores.apply(
+        lambda row: row['PunctajNormalizatTodo_E'] * (1 + row['Ajustare_Delay/Bonus'] / 100.0), axis=1
+    )
+
+    exam_weights = data[['course_id', 'exam_type_id', 'exam_weight']].drop_duplicates()
+    final_scores = final_scores.merge(exam_weights,
+                                      on=['course_id', 'exam_type_id'],
+                                      how='left')
+
+    final_scores['PunctajComponentaExamene'] = final_scores['PunctajAjustatTodo_E'] * (final_scores['exam_weight'] / 100.0)
+
+    pce = final_scores.groupby(['student_id', 'course_id'])['PunctajComponentaExamene'].sum().reset_index()
+
+    presences_data = data[['student_id', 'course_id', 'exam_type_id', 'presences', 'required_presences', 'exam_weight']]\
+                    .drop_duplicates()
+
+    presences_data['IndeplinitPrezente_E'] = presences_data.apply(lambda row: row['presences'] >= row['required_presences'], axis=1)
+
+    presences_data['scor_prezenta_ponderat'] = presences_data['IndeplinitPrezente_E'] * presences_data['exam_weight']
+
+    presences_scores = presences_data.groupby(['student_id', 'course_id']).agg(
+        scor_prezenta_total=('scor_prezenta_ponderat', 'sum'),
+        total_greutati_exam=('exam_weight', 'sum')
+    ).reset_index()
+
+    presences_scores['ScorPrezenteExam'] = (
+        presences_scores['scor_prezenta_total'] / presences_scores['total_greutati_exam']
+    ) * 100
+
+    final_data = pce.merge(presences_scores[['student_id', 'course_id', 'ScorPrezenteExam']],
+                            on=['student_id', 'course_id'],
+                            how='inner')
+
+    adjustment_unique = adjustments[['student_id', 'course_id', 'Ajustare_Delay/Bonus']].drop_duplicates()
+
+    final_data = final_data.merge(adjustment_unique,
+                                on=['student_id', 'course_id'],
+                                how='left')
+
+    final_data['NotaAproximativa'] = (
+        (final_data['PunctajComponentaExamene'] * w_todos) +
+        (final_data['ScorPrezenteExam'] * w_presence)
+    ) / 1000.0
+
+    final_data['Class'] = np.where(final_data['NotaAproximativa'] >= 5.0, 'Promovat', 'Nepromovat')
+
+    return final_data
+
+
+# The frame the original code classified: the join as pd.read_sql_query returns it (float64 / object columns)
+def untyped_frame(conn, where: str = "", params=()) -> pd.DataFrame:
+    return pd.read_sql_query(classification_query(where), conn, params=params)
+
+
+# Class is compared exactly: a drift below rtol still flips a grade that sits on PASSING_GRADE
+def assert_same_metrics(actual: pd.DataFrame, expected: pd.DataFrame):
+    assert actual['Class'].tolist() == expected['Class'].tolist()
+    actual = actual[METRIC_COLUMNS].astype({'student_id': 'int64', 'course_id': 'int64'}).reset_index(drop=True)
+    expected = expected[METRIC_COLUMNS].astype({'student_id': 'int64', 'course_id': 'int64', 'PunctajComponentaExamene': 'float64',
+                                                'ScorPrezenteExam': 'float64', 'Ajustare_Delay/Bonus': 'float64'})
+    assert_frame_equal(actual, expected.reset_index(drop=True), check_dtype=False, rtol=1e-5)
+
+
+# Classification frame rows: (student, course, exam type, todo, deadline, handled, points), presences per component
+# typed=False leaves the columns as pandas infers them from the values, as the original code saw them
+def handmade_frame(todos, presences, typed=True) -> pd.DataFrame:
+    rows = []
+    for student_id, course_id, exam_type_id, todo_id, deadline, handled, points in todos:
+        rows.append({
+            'student_id': student_id, 'course_id': course_id, 'exam_type_id': exam_type_id,
+            'exam_weight': 50, 'required_presences': 7, 'todo_id': todo_id, 'max_points': 10.0,
+            'todo_weight': 1.0 + todo_id % 3, 'deadline': deadline, 'points': points, 'handled': handled,
+            'diff_days': None if handled is None else handled - deadline,
+            'presences': presences[(student_id, course_id, exam_type_id)],
+        })
+
+    return pd.DataFrame(rows).astype(CLASSIFICATION_DTYPES) if typed else pd.DataFrame(rows)
+
+
+def test_matches_baseline_on_seeded_database(conn):
+    expected = baseline_compute_metrics(untyped_frame(conn), WEIGHTS)
+    actual = compute_metrics(read_classification_frame(conn), WEIGHTS)
+
+    assert len(actual) == len(expected) > 0
+    assert_same_metrics(actual, expected)
+
+
+# More than len(ADJUST_RATES) off-deadline todos spread over two courses: the rate sequence continues from
+# course 1 into course 2 and runs out there. Todos 3 / 4 and 7 / 8 share a deadline with different delays, so
+# the order inside a tie (the join's exam type, todo order) decides which one gets the larger rate
+def test_rate_sequence_spans_courses_and_keeps_deadline_ties_in_join_order():
+    todos = [
+        (1, 1, 1, 1, 20000, 20010, 8.0),
+        (1, 1, 1, 2, 20005, 20005, 9.0),    # on the deadline, no rate consumed
+        (1, 1, 2, 3, 20010, 20002, 7.0),
+        (1, 1, 2, 4, 20010, 20040, 6.0),
+        (1, 1, 2, 5, 20020, None, 0.0),      # never handled
+        (1, 2, 1, 6, 19990, 19985, 10.0),
+        (1, 2, 1, 7, 20001, 20004, 5.0),
+        (1, 2, 2, 8, 20001, 20030, 4.0),
+        (1, 2, 2, 9, 20050, 20049, 3.0),     # past the fifth rate, adjusts by 0
+        (2, 1, 1, 1, 20000, 20003, 2.0),     # another student starts their own sequence
+        (2, 1, 2, 3, 20010, 20010, 1.0),
+    ]
+    presences = {(1, 1, 1): 8, (1, 1, 2): 3, (1, 2, 1): 7, (1, 2, 2): None, (2, 1, 1): 9, (2, 1, 2): 9}
+    expected = baseline_compute_metrics(handmade_frame(todos, presences, typed=False), WEIGHTS)
+    actual = compute_metrics(handmade_frame(todos, presences), WEIGHTS)
+
+    assert_same_metrics(actual, expected)
+    assert (actual['Ajustare_Delay/Bonus'] != 0).all()
+
+
+@pytest.mark.parametrize('weights', [(80, 20), (60, 40)])
+def test_matches_baseline_for_both_weight_pairs(conn, weights):
+    where, params = "WHERE S.id <= ?", (20,)
+
+    assert_same_metrics(compute_metrics(read_classification_frame(conn, where, params), weights),
+                        baseline_compute_metrics(untyped_frame(conn, where, params), weights))
+
+
+# The SQL backend aggregates in SQLite (different summation order), hence the relative tolerance
+def test_sql_backend_matches_pandas(conn):
+    expected = compute_metrics(read_classification_frame(conn), WEIGHTS)
+    actual = compute_metrics_sql(conn, weights=WEIGHTS)
+
+    assert len(actual) == len(expected) > 0
+    assert_same_metrics(actual, expected)
+
+
+# Student ranges classified by two worker processes (several ranges each) give the serial frame
+@pytest.mark.parametrize('backend', ['pandas', 'sql'])
+def test_parallel_matches_serial(conn, seeded_db, backend):
+    expected = compute_metrics(read_classification_frame(conn), WEIGHTS)
+    actual = compute_metrics_parallel(conn, seeded_db, 2, chunk_students=7, weights=WEIGHTS, backend=backend)
+
+    assert len(actual) == len(expected) > 0
+    assert_same_metrics(actual, expected)
+
+
+# A snapshot at a cutoff is compute_metrics over the join with the hasDone rows handled after it left out,
+# i.e. with their columns NULL as for a todo that was never handled
+def test_as_of_snapshots_match_filtered_compute_metrics(conn):
+    from as_of import as_of_features
+
+    data = read_classification_frame(conn)
+    handled = data['handled'].dropna()
+    cutoffs = [int(handled.min()) - 1, *np.quantile(handled, [0.25, 0.5, 0.75]).astype(int), int(handled.max())]
+
+    snapshots = as_of_features(conn, cutoffs, chunk_students=25)
+    columns = ['PunctajComponentaExamene', 'ScorPrezenteExam', 'Ajustare_Delay/Bonus']
+
+    for cutoff in cutoffs:
+        filtered = data.copy()
+        unseen = filtered['handled'].isna() | (filtered['handled'] > cutoff)
+        filtered.loc[unseen, ['points', 'handled', 'diff_days']] = pd.NA
+
+        expected = compute_metrics(filtered, WEIGHTS)
+        actual = snapshots[snapshots['cutoff'] == cutoff]
+
+        assert actual[['student_id', 'course_id']].to_numpy().tolist() == \
+               expected[['student_id', 'course_id']].to_numpy().astype(int).tolist()
+        for column in columns:
+            np.testing.assert_allclose(actual[column].to_numpy(dtype=np.float64),
+                                       expected[column].to_numpy(dtype=np.float64), rtol=1e-5, atol=1e-8)
+
+
+# One student, one course with two exam types (weight 50 each, presences met for the first one only) whose two
+# todos score 3.3 / 10 and 6.7 / 10 at weight 0.5, handled on the deadline: PunctajComponentaExamene and
+# ScorPrezenteExam are exactly 50, so the grade is exactly PASSING_GRADE. Summed in float32 the todo score
+# is 49.999996 and the student fails
+@pytest.fixture
+def pass_mark_db(tmp_path):
+    db_file = str(tmp_path / 'pass_mark.db')
+    conn = shared_connection(db_file)
+    setup_database(conn)
+
+    conn.executescript("""
+        INSERT INTO ExamType VALUES (1, 'Laboratory'), (2, 'Exam');
+        INSERT INTO Student VALUES (1, 'Student');
+        INSERT INTO Course VALUES (1, 'Course');
+        INSERT INTO hasWeights VALUES (1, 1, 50, 5), (1, 2, 50, 5);
+        INSERT INTO hasTodo VALUES (1, 1, 1, 10, 0.5, 20400), (2, 1, 1, 10, 0.5, 20410),
+                                   (3, 1, 2, 10, 0.5, 20420), (4, 1, 2, 10, 0.5, 20430);
+        INSERT INTO hasDone VALUES (1, 1, 3.3, 20400), (1, 2, 6.7, 20410), (1, 3, 3.3, 20420), (1, 4, 6.7, 20430);
+        INSERT INTO hasPresences VALUES (1, 1, 1, 7), (1, 1, 2, 2);
+    """)
+    conn.commit()
+
+    yield conn
+    close_connections(db_file)
+
+
+@pytest.mark.parametrize('weights', [(80, 20), (60, 40)])
+def test_grade_on_the_pass_mark_passes_with_typed_frame(pass_mark_db, weights):
+    expected = baseline_compute_metrics(untyped_frame(pass_mark_db), weights)
+
+    assert expected['NotaAproximativa'].tolist() == [PASSING_GRADE]
+    assert expected['Class'].tolist() == ['Promovat']
+
+    for actual in (compute_metrics(read_classification_frame(pass_mark_db), weights),
+                   compute_metrics_sql(pass_mark_db, weights=weights)):
+        assert_same_metrics(actual, expected)
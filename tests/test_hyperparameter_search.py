@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from classification import compute_metrics, read_classification_frame
+from cross_validation import stratified_folds, CV_FOLDS, CV_SEED
+from naive_bayes import NaiveBayes, encode_classes, holdout_split
+from tokenization import TOKEN_VOCABULARY, tokenize
+from hyperparameter_search import search_hyperparameters, SEARCH_GRID, SEARCH_HOLDOUT, SEARCH_SEED
+
+WEIGHTS = (80, 20)
+SMALL_GRID = {
+    'PunctajComponentaExamene': [20.0, 40.0, 70.0],
+    'ScorPrezenteExam': [40.0, 80.0],
+    'Ajustare_Delay/Bonus': [-2.0, 0.0, 2.0],
+}
+
+
+@pytest.fixture
+def final_data(conn):
+    return compute_metrics(read_classification_frame(conn), WEIGHTS)
+
+
+def test_grid_over_the_limit_fails_before_scoring(final_data):
+    with pytest.raises(ValueError, match='max_candidates'):
+        search_hyperparameters(final_data, mode='grid', grid=SEARCH_GRID, max_candidates=1000, workers=1)
+
+
+# Keeping only the top candidates while streaming gives the head of the full ranking
+def test_streamed_top_matches_the_full_ranking(final_data):
+    full = search_hyperparameters(final_data, mode='grid', grid=SMALL_GRID, alphas=[0.5, 1.0], workers=1, top=10_000)
+    head = search_hyperparameters(final_data, mode='grid', grid=SMALL_GRID, alphas=[0.5, 1.0], workers=1, top=3)
+
+    scores = [result['cv_accuracy'] for result in full['top']]
+    assert len(scores) == full['candidates'] == head['candidates']
+    assert scores == sorted(scores, reverse=True)
+    assert head['top'] == full['top'][:3]
+    assert head['best']['cv_accuracy'] >= head['baseline']['cv_accuracy']
+    assert 0 < head['holdout_documents'] < head['documents']
+
+
+# Cross validated accuracy of fitting the tokenized documents themselves, on the folds the search uses
+def fitted_cv_accuracy(final_data, token_bins, alpha) -> float:
+    class_indices = encode_classes(final_data['Class'])
+    search_idx, _ = holdout_split(len(class_indices), SEARCH_HOLDOUT, SEARCH_SEED)
+
+    codes = tokenize(final_data, token_bins)[search_idx]
+    labels = class_indices[search_idx]
+    folds = stratified_folds(labels, CV_FOLDS, 1, CV_SEED)[0]
+
+    correct = 0
+    for fold in range(CV_FOLDS):
+        model = NaiveBayes(TOKEN_VOCABULARY, token_bins=token_bins, alpha=alpha)
+        model.fit(codes[folds != fold], labels[folds != fold])
+        correct += np.count_nonzero(model.predict_codes(codes[folds == fold]) == labels[folds == fold])
+
+    return correct / len(labels)
+
+
+# The histogram scores (rebinned and merged per fold) are the accuracies of real fits: every 7th candidate
+# of the ranking and the current configuration
+def test_histogram_scores_match_fitted_models(final_data):
+    report = search_hyperparameters(final_data, mode='grid', grid=SMALL_GRID, alphas=[0.01, 1.0, 5.0], workers=1, top=10_000)
+
+    for result in report['top'][::7] + [report['baseline']]:
+        expected = fitted_cv_accuracy(final_data, result['token_bins'], result['alpha'])
+        assert result['cv_accuracy'] == pytest.approx(expected, abs=1e-12)
@@ -0,0 +1,29 @@
+import numpy as np
+from naive_bayes import NaiveBayes
+from tokenization import TOKEN_VOCABULARY
+from model_store import save_model, load_model
+
+CODES = np.array([[0, 3, 6], [1, 4, 7], [2, 5, 8], [0, 4, 8], [2, 3, 7], [1, 5, 6]])
+LABELS = np.array([0, 1, 0, 1, 0, 1])
+
+
+# Online updates of a memory-mapped model work on private copies of the counts, the file is not modified
+def test_partial_fit_and_forget_after_load(tmp_path):
+    path = str(tmp_path / 'model.nbm')
+    save_model(NaiveBayes(TOKEN_VOCABULARY).fit(CODES[:4], LABELS[:4]), path)
+    with open(path, 'rb') as f:
+        saved = f.read()
+
+    model = load_model(path)
+    assert not model.token_count.flags.writeable
+
+    model.partial_fit(CODES[4:], LABELS[4:])
+    expected = NaiveBayes(TOKEN_VOCABULARY).fit(CODES, LABELS)
+    np.testing.assert_array_equal(model.token_count, expected.token_count)
+    np.testing.assert_allclose(model.predict_log_proba(CODES), expected.predict_log_proba(CODES))
+
+    model.forget(CODES[4:], LABELS[4:])
+    np.testing.assert_array_equal(model.class_count, load_model(path).class_count)
+
+    with open(path, 'rb') as f:
+        assert f.read() == saved
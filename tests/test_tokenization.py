@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+from tokenization import tokenize, decode_documents, Dataset, TOKEN_BINS
+from hyperparameter_search import feature_cuts, cut_levels
+
+
+# The row-wise tokenizer tokenize() replaced
+def baseline_generate_tokens(row: pd.Series) -> list:
+    tokens = [None] * 3
+
+    pce = row['PunctajComponentaExamene']
+    spe = row['ScorPrezenteExam']
+    adj = row['Ajustare_Delay/Bonus']
+
+    if pce < 30:
+        tokens[0] = 'low_todo'
+    elif 30 <= pce < 60:
+        tokens[0] = 'medium_todo'
+    else:
+        tokens[0] ='good_todo'
+
+    if spe < 50:
+        tokens[1] = 'low_presences'
+    elif 50 <= spe < 90:
+        tokens[1] = 'medium_presences'
+    else:
+        tokens[1] = 'good_presences'
+
+    if adj < -1.0:
+        tokens[2] = 'low_motivation'
+    elif -1.0 < adj <= 1.0:
+        tokens[2] = 'medium_motivation'
+    else:
+        tokens[2] = 'high_motivation'
+
+    return tokens
+
+
+def test_matches_baseline_including_nan():
+    values = [np.nan, -5.0, -1.5, -0.5, 0.0, 0.5, 1.0, 1.5, 29.9, 30.0, 45.0, 50.0, 59.9, 60.0, 89.9, 90.0, 100.0]
+    grid = pd.DataFrame([(pce, spe, adj) for pce in values for spe in values for adj in values],
+                        columns=[column for column, _, _ in TOKEN_BINS])
+
+    expected = grid.apply(baseline_generate_tokens, axis=1).tolist()
+    assert decode_documents(tokenize(grid)) == expected
+
+
+# Documented boundary fix: -1.0 used to fall through to high_motivation
+def test_adjustment_of_minus_one_is_medium_motivation():
+    row = {'PunctajComponentaExamene': [10.0], 'ScorPrezenteExam': [10.0], 'Ajustare_Delay/Bonus': [-1.0]}
+    assert decode_documents(tokenize(row))[0][2] == 'medium_motivation'
+
+
+# The hyperparameter search bins NaN the same way as tokenize
+def test_search_levels_send_nan_to_the_top_bin():
+    for _, thresholds, _ in TOKEN_BINS:
+        cuts = feature_cuts([value for value, _ in thresholds], sorted({inclusive for _, inclusive in thresholds}))
+        assert cut_levels(np.array([np.nan]), cuts)[0] == len(cuts)
+
+
+def test_dataset_rejects_unknown_class_labels():
+    final_data = {'student_id': [1, 1], 'course_id': [1, 2], 'PunctajComponentaExamene': [50.0, 70.0],
+                  'ScorPrezenteExam': [60.0, 95.0], 'Ajustare_Delay/Bonus': [0.0, 1.5], 'Class': ['Promovat', 'promovat']}
+
+    with pytest.raises(ValueError, match='promovat'):
+        Dataset.from_metrics(final_data)
+
+    final_data['Class'] = ['Promovat', 'Nepromovat']
+    assert Dataset.from_metrics(final_data).labels.tolist() == [0, 1]
@@ -1,46 +1,186 @@
-import pandas as pd
+import numpy as np
+from instrumentation import instrumented
 
-def generate_tokens(row: pd.Series) -> list:
-    tokens = [None] * 3
+# (column, thresholds, tokens) for every tokenized feature
+# A value moves past (threshold, inclusive) when value >= threshold if inclusive, else when value > threshold
+TOKEN_BINS = [
+    ('PunctajComponentaExamene', [(30, True), (60, True)], ['low_todo', 'medium_todo', 'good_todo']),
+    ('ScorPrezenteExam', [(50, True), (90, True)], ['low_presences', 'medium_presences', 'good_presences']),
+    ('Ajustare_Delay/Bonus', [(-1.0, True), (1.0, False)], ['low_motivation', 'medium_motivation', 'high_motivation']),
+]
 
-    pce = row['PunctajComponentaExamene']
-    spe = row['ScorPrezenteExam']
-    adj = row['Ajustare_Delay/Bonus']
+# Every feature owns a contiguous block of token ids
+TOKEN_VOCABULARY = [token for _, _, tokens in TOKEN_BINS for token in tokens]
 
-    if pce < 30:
-        tokens[0] = 'low_todo' 
-    elif 30 <= pce < 60:
-        tokens[0] = 'medium_todo'
-    else:
-        tokens[0] ='good_todo'
+CLASSES = ['Promovat', 'Nepromovat']
 
 
-    if spe < 50:
-        tokens[1] = 'low_presences'
-    elif 50 <= spe < 90:
-        tokens[1] = 'medium_presences'
-    else:
-        tokens[1] = 'good_presences'
+# NaN fails every comparison of the original if / elif chains and lands in their else branch, the top bin
+def bin_feature(values: np.ndarray, thresholds) -> np.ndarray:
+    codes = np.zeros(len(values), dtype=np.int8)
+    for threshold, inclusive in thresholds:
+        codes += (values >= threshold) if inclusive else (values > threshold)
 
+    codes[np.isnan(values)] = len(thresholds)
+    return codes
 
-    if adj < -1.0:
-        tokens[2] = 'low_motivation'
-    elif -1.0 < adj <= 1.0:
-        tokens[2] = 'medium_motivation'
-    else:
-        tokens[2] = 'high_motivation'
 
-    return tokens
+# Final metrics (DataFrame or dict of columns) -> int8 token-code matrix (documents x features),
+# indexed into TOKEN_VOCABULARY
+@instrumented('tokenization.tokenize', rows=len)
+def tokenize(final_data, token_bins=TOKEN_BINS) -> np.ndarray:
+    n_documents = len(np.asarray(final_data[token_bins[0][0]]))
+    codes = np.empty((n_documents, len(token_bins)), dtype=np.int8)
 
+    offset = 0
+    for idx, (column, thresholds, tokens) in enumerate(token_bins):
+        codes[:, idx] = bin_feature(np.asarray(final_data[column], dtype=np.float64), thresholds) + offset
+        offset += len(tokens)
 
-def run_fd_tokenization(final_data):
+    return codes
+
+
+# String view of a token-code matrix, e.g. ['low_todo', 'good_presences', 'medium_motivation']
+def decode_documents(codes: np.ndarray, vocabulary=TOKEN_VOCABULARY) -> list:
+    return np.asarray(vocabulary, dtype=object)[codes].tolist()
+
+
+# AttendanceStats column -> metric name, for the rows materialized by classification.write_attendance_stats
+ATTENDANCE_FEATURES = {
+    'student_id': 'student_id',
+    'course_id': 'course_id',
+    'todo_score': 'PunctajComponentaExamene',
+    'presence_score': 'ScorPrezenteExam',
+    'adjustment': 'Ajustare_Delay/Bonus',
+    'final_grade': 'NotaAproximativa',
+    'success': 'Class',
+}
+
+
+# Materialized metrics as a dict of columns (accepted by tokenize / run_fd_tokenization), without pandas
+def read_attendance_features(conn, where="", params=()) -> dict:
+    rows = conn.execute(f"SELECT {', '.join(ATTENDANCE_FEATURES)} FROM AttendanceStats {where} ORDER BY student_id, course_id;",
+                        params).fetchall()
+    columns = list(zip(*rows)) if rows else [()] * len(ATTENDANCE_FEATURES)
+
+    features = {}
+    for (column, name), values in zip(ATTENDANCE_FEATURES.items(), columns):
+        dtype = np.int64 if column.endswith('_id') else object if column == 'success' else np.float64
+        features[name] = np.array(values, dtype=dtype)
+
+    return features
+
+
+def generate_tokens(row) -> list:
+    return decode_documents(tokenize({column: [row[column]] for column, _, _ in TOKEN_BINS}))[0]
+
+
+# Tokenized documents passed from tokenization to training: int8 token codes (documents x features), the class
+# of every document as one bit (index into CLASSES) and the int32 (student_id, course_id) keys
+# take() returns a view over the same arrays: the rows are only gathered when codes / labels / keys are read,
+# and a slice of rows is gathered as a NumPy view
+class Dataset:
+    def __init__(self, codes: np.ndarray, class_bits: np.ndarray, student_ids: np.ndarray, course_ids: np.ndarray,
+                 n_documents: int, classes=CLASSES, rows=None):
+        self._codes = codes
+        self._class_bits = class_bits
+        self._student_ids = student_ids
+        self._course_ids = course_ids
+        self.n_documents = n_documents
+        self.classes = list(classes)
+        self.rows = rows
+
+        if rows is None:
+            self.length = n_documents
+        elif isinstance(rows, slice):
+            self.length = len(range(n_documents)[rows])
+        else:
+            self.length = len(rows)
+
+    @classmethod
+    def from_metrics(cls, final_data, token_bins=TOKEN_BINS, classes=CLASSES):
+        if len(classes) != 2:
+            raise ValueError("Dataset packs one bit per document, it needs exactly two classes")
+
+        labels = np.asarray(final_data['Class'])
+        unknown = sorted({str(label) for label in labels[~np.isin(labels, classes)]})
+        if unknown:
+            raise ValueError(f"Unknown class labels {unknown}, expected one of {list(classes)}")
+
+        codes = tokenize(final_data, token_bins)
+        class_bits = np.packbits(labels == classes[1])
+        return cls(codes, class_bits,
+                   np.asarray(final_data['student_id'], dtype=np.int32),
+                   np.asarray(final_data['course_id'], dtype=np.int32),
+                   len(codes), classes)
+
+    def _gather(self, array: np.ndarray) -> np.ndarray:
+        return array if self.rows is None else array[self.rows]
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._gather(self._codes)
+
+    # Class indices (uint8)
+    @property
+    def labels(self) -> np.ndarray:
+        return self._gather(np.unpackbits(self._class_bits, count=self.n_documents))
+
+    @property
+    def class_labels(self) -> np.ndarray:
+        return np.asarray(self.classes, dtype=object)[self.labels]
+
+    @property
+    def student_ids(self) -> np.ndarray:
+        return self._gather(self._student_ids)
+
+    @property
+    def course_ids(self) -> np.ndarray:
+        return self._gather(self._course_ids)
+
+    # Bytes held by the dataset (shared with its views) and by its own row index
+    @property
+    def nbytes(self) -> int:
+        index = self.rows.nbytes if isinstance(self.rows, np.ndarray) else 0
+        return self._codes.nbytes + self._class_bits.nbytes + self._student_ids.nbytes + self._course_ids.nbytes + index
+
+    # View of the given rows (slice, integer index array or boolean mask) of this dataset
+    def take(self, rows):
+        if isinstance(rows, np.ndarray) and rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+
+        # Row numbers are relative to this view; a slice of a slice stays a slice
+        if isinstance(self.rows, slice) and isinstance(rows, slice):
+            selected = range(self.n_documents)[self.rows][rows]
+            rows = slice(selected.start, selected.stop if selected.stop >= 0 else None, selected.step)
+        elif self.rows is not None:
+            rows = np.arange(self.n_documents)[self.rows][rows]
+
+        return Dataset(self._codes, self._class_bits, self._student_ids, self._course_ids, self.n_documents, self.classes, rows)
+
+    # Arrays of a compacted copy, e.g. for the stage cache
+    def to_arrays(self) -> dict:
+        return {'codes': self.codes, 'class_bits': np.packbits(self.labels), 'student_ids': self.student_ids,
+                'course_ids': self.course_ids, 'n_documents': np.array(len(self))}
+
+    @classmethod
+    def from_arrays(cls, arrays: dict, classes=CLASSES):
+        return cls(arrays['codes'], arrays['class_bits'], arrays['student_ids'], arrays['course_ids'],
+                   int(arrays['n_documents']), classes)
+
+
+@instrumented('tokenization', rows=len)
+def run_fd_tokenization(final_data) -> Dataset:
     print("\n\n>>> Started data tokenization <<<\n")
 
-    final_data['Document'] = final_data.apply(generate_tokens, axis=1)
-    train_set = list(zip(final_data['Document'], final_data['Class']))
-    
+    dataset = Dataset.from_metrics(final_data)
+
     to_show = 5
+    preview = dataset.take(slice(0, to_show))
     print(f"Preview {to_show} lines from dataframe with relevant metrics")
-    print(train_set[:to_show])
+    print(list(zip(decode_documents(preview.codes), preview.class_labels)))
 
-    return train_set
\ No newline at end of file
+    return dataset
@@ -0,0 +1,124 @@
+import time
+import numpy as np
+from dbconfig import create_connection, epoch_day, format_epoch_day, DB_NAME
+from classification import date_weights, CALCULATION_INTERVAL, PASSING_GRADE
+from tokenization import read_attendance_features
+
+# Grades are computed for at most this many (weight pair, row) cells at a time (8 bytes each)
+SCENARIO_BLOCK_CELLS = 4_000_000
+
+
+# NotaAproximativa of every row under every (w_presence, w_todos) pair, shape (pairs x rows)
+# Same expression as classification.grade_metrics, broadcast over the weight pairs
+def scenario_grades(components, weights) -> np.ndarray:
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, 2)
+    todo_score = np.asarray(components['PunctajComponentaExamene'], dtype=np.float64)
+    presence_score = np.asarray(components['ScorPrezenteExam'], dtype=np.float64)
+
+    return ((todo_score * weights[:, 1:]) + (presence_score * weights[:, :1])) / 1000.0
+
+
+# Every date of CALCULATION_INTERVAL as epoch days
+def calculation_days(interval=CALCULATION_INTERVAL) -> np.ndarray:
+    return np.arange(epoch_day(interval[0]), epoch_day(interval[1]) + 1)
+
+
+# Re-grades the date-independent components (PunctajComponentaExamene, ScorPrezenteExam) under every
+# scenario's (w_presence, w_todos) pair. Dates sharing a weight pair share one broadcast: only the distinct
+# pairs are graded, in blocks of SCENARIO_BLOCK_CELLS. `baseline` (the current Class column) adds the number
+# of rows each scenario would reclassify
+def evaluate_scenarios(components, weights, baseline=None) -> list:
+    weights = np.asarray(weights).reshape(-1, 2)
+    pairs, scenario_pair = np.unique(weights, axis=0, return_inverse=True)
+
+    n_rows = len(components['PunctajComponentaExamene'])
+    promoted_now = np.asarray(baseline) == 'Promovat' if baseline is not None else None
+    block = max(SCENARIO_BLOCK_CELLS // max(n_rows, 1), 1)
+
+    results = []
+    for start in range(0, len(pairs), block):
+        grades = scenario_grades(components, pairs[start:start + block])
+        promoted = grades >= PASSING_GRADE
+
+        for grade_row, promoted_row in zip(grades, promoted):
+            result = {
+                'promoted': int(np.count_nonzero(promoted_row)),
+                'mean_grade': float(grade_row.mean()) if n_rows else 0.0,
+            }
+            if promoted_now is not None:
+                result['reclassified'] = int(np.count_nonzero(promoted_row != promoted_now))
+            results.append(result)
+
+    pairs = pairs.tolist()
+    return [{'w_presence': pairs[idx][0], 'w_todos': pairs[idx][1], 'rows': n_rows, **results[idx]}
+            for idx in scenario_pair.ravel()]
+
+
+# Scenarios from calculation dates (dd.mm.yyyy) and / or explicit (w_presence, w_todos) pairs; without
+# either, every date of CALCULATION_INTERVAL
+def build_scenarios(dates=None, weights=None) -> tuple:
+    labels, pairs = [], []
+
+    if dates or not weights:
+        days = np.array([epoch_day(value) for value in dates]) if dates else calculation_days()
+        labels += [format_epoch_day(day) for day in days.tolist()]
+        pairs += date_weights(days).tolist()
+
+    for w_presence, w_todos in weights or []:
+        labels.append(f"weights {w_presence:g}/{w_todos:g}")
+        pairs.append([w_presence, w_todos])
+
+    return labels, pairs
+
+
+# What-if rescoring over the components materialized in AttendanceStats
+def run_what_if(dates=None, weights=None, db_file=DB_NAME):
+    print("\n\n>>> What-if rescoring <<<\n")
+
+    conn = create_connection(db_file, read_only=True)
+    if not conn:
+        print("Database operation aborted.")
+        return None
+
+    components = read_attendance_features(conn)
+    conn.close()
+    if not len(components['Class']):
+        print("AttendanceStats is empty, run `python3 main.py classify` first")
+        return None
+
+    labels, pairs = build_scenarios(dates, weights)
+
+    start = time.perf_counter()
+    results = evaluate_scenarios(components, pairs, components['Class'])
+    elapsed = time.perf_counter() - start
+
+    n_pairs = len({(result['w_presence'], result['w_todos']) for result in results})
+    print(f"\t{len(results):,} scenarios ({n_pairs} distinct weight pairs) over {results[0]['rows']:,} (student, course) "
+          f"rows in {elapsed * 1000:.1f} ms")
+
+    # Consecutive dates with the same weights are reported as one range
+    n_dates = len(labels) - len(weights or [])
+    runs = _date_runs(labels[:n_dates], results[:n_dates]) + \
+           [[label, label, result] for label, result in zip(labels[n_dates:], results[n_dates:])]
+
+    for first, last, result in runs:
+        label = first if first == last else f"{first} - {last}"
+        print(f"\t{label:<25} presences {result['w_presence']:>3g} / todos {result['w_todos']:>3g}: "
+              f"{result['promoted'] / result['rows'] * 100:6.2f}% promoted, mean grade {result['mean_grade']:.2f}, "
+              f"{result['reclassified']:,} rows reclassified")
+
+    for label, result in zip(labels, results):
+        result['scenario'] = label
+
+    return results
+
+
+def _date_runs(labels, results):
+    runs = []
+    for label, result in zip(labels, results):
+        if runs and (runs[-1][2]['w_presence'], runs[-1][2]['w_todos']) == (result['w_presence'], result['w_todos']):
+            runs[-1][1] = label
+        else:
+            runs.append([label, label, result])
+
+    return runs